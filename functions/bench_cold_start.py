@@ -0,0 +1,219 @@
+"""Benchmark cold start cost for every function entry point
+
+Each measurement runs in a fresh interpreter and records two numbers:
+
+- import: time to import the entry point module
+- first call: time for the first main() call after the import
+
+Appwrite API calls are answered locally with canned responses and feed or
+article URLs point at a closed local port. The first call therefore measures
+lazy imports and setup work, not network latency.
+
+Usage:
+    python bench_cold_start.py [--runs N] [--json results.json]
+                               [--baseline results.json] [function_dir ...]
+
+With --baseline, any function whose best import or first call time grew by
+more than 20% and at least 10 ms is reported and the script exits with status 1.
+Run "make common" first so each function directory has the shared modules it
+is deployed with.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+FUNCTIONS_DIR = os.path.dirname(os.path.abspath(__file__))
+UNREACHABLE_URL = "http://127.0.0.1:9/feed"
+REGRESSION_THRESHOLD = 0.2
+REGRESSION_MIN_MS = 10
+
+FEED_DOCUMENT = {
+    "$id": "bench",
+    "rss_url": UNREACHABLE_URL,
+    "feed_title": "Benchmark",
+    "last_update": "2025-01-01T00:00:00.000+00:00",
+    "update_interval_minutes": 60,
+}
+
+# function dir -> (entry point module, request body, documents returned by list calls)
+ENTRY_POINTS = {
+    "index_news_feed": ("index_news_feed", {"feed_id": "bench"}, [FEED_DOCUMENT]),
+    "index_podcast_feed": (
+        "index_podcast_feed",
+        {"feed_id": "bench"},
+        [FEED_DOCUMENT],
+    ),
+    "create_news_feed": ("create_news_feed", {"url": UNREACHABLE_URL}, []),
+    "create_podcast_feed": ("create_podcast_feed", {"url": UNREACHABLE_URL}, []),
+    "scheduler": ("scheduler", {}, []),
+    "summarize_article": (
+        "summarize",
+        {"user_id": "bench", "article_url": "https://example.com/article"},
+        [],
+    ),
+    "get_article": ("get_article", {"url": UNREACHABLE_URL}, []),
+    "create_daily_digest": ("create_daily_digest", {}, []),
+    "record_listen_time": (
+        "record_listen_time",
+        {"user_id": "bench", "title": "Benchmark"},
+        [],
+    ),
+    "presummarize_articles": ("presummarize_articles", {}, []),
+}
+
+# get_article is deployed from the summarize_article directory
+SOURCE_DIRS = {"get_article": "summarize_article"}
+
+CHILD_SCRIPT = """
+import json, sys, time
+
+source_dir, module_name, body, documents = sys.argv[1:5]
+sys.path.insert(0, source_dir)
+
+start = time.perf_counter()
+module = __import__(module_name)
+import_s = time.perf_counter() - start
+
+import appwrite.client
+
+documents = json.loads(documents)
+
+
+def call(self, method, path="", headers=None, params=None, response_type="json"):
+    if path.endswith("/download"):
+        return json.dumps({"summary": "cached"}).encode()
+    if method == "get" and path.endswith("/documents"):
+        return {"total": len(documents), "documents": documents}
+    return {
+        "$id": "bench",
+        "status": "completed",
+        "responseStatusCode": 200,
+        "tokens_used": 0,
+    }
+
+
+appwrite.client.Client.call = call
+
+
+class Request:
+    def __init__(self, body):
+        self.body = body
+
+
+class Response:
+    def json(self, data, statusCode=200):
+        return data
+
+
+class Context:
+    def __init__(self, body):
+        self.req = Request(body)
+        self.res = Response()
+
+    def log(self, message):
+        pass
+
+    def error(self, message):
+        pass
+
+
+start = time.perf_counter()
+try:
+    module.main(Context(body))
+except Exception:
+    pass
+first_call_s = time.perf_counter() - start
+print(json.dumps({"import": import_s, "first_call": first_call_s}))
+"""
+
+
+def measure(function_dir: str) -> dict:
+    """Run one cold start of a function in a fresh interpreter"""
+    module_name, body, documents = ENTRY_POINTS[function_dir]
+    source_dir = os.path.join(
+        FUNCTIONS_DIR, SOURCE_DIRS.get(function_dir, function_dir)
+    )
+    res = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            CHILD_SCRIPT,
+            source_dir,
+            module_name,
+            json.dumps(body),
+            json.dumps(documents),
+        ],
+        capture_output=True,
+        text=True,
+        check=True,
+        cwd=source_dir,
+    )
+    return json.loads(res.stdout.strip().splitlines()[-1])
+
+
+def benchmark(function_dir: str, runs: int) -> dict:
+    """Best import and first call time in milliseconds over several runs"""
+    samples = [measure(function_dir) for _ in range(runs)]
+    return {
+        key: min(sample[key] for sample in samples) * 1000
+        for key in ("import", "first_call")
+    }
+
+
+def find_regressions(results: dict, baseline: dict) -> list:
+    """List the timings that grew past both regression thresholds"""
+    regressions = []
+    for function_dir, timings in results.items():
+        for key, value in timings.items():
+            previous = baseline.get(function_dir, {}).get(key)
+            if (
+                previous
+                and value > previous * (1 + REGRESSION_THRESHOLD)
+                and value - previous >= REGRESSION_MIN_MS
+            ):
+                regressions.append(
+                    f"{function_dir} {key}: {previous:.1f} ms -> {value:.1f} ms"
+                )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("function_dirs", nargs="*", default=list(ENTRY_POINTS))
+    parser.add_argument("--runs", type=int, default=9)
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--baseline", help="compare against saved results")
+    args = parser.parse_args()
+
+    results = {}
+    print(f"{'function':<22} {'import ms':>10} {'first call ms':>14} {'total ms':>9}")
+    for function_dir in args.function_dirs:
+        try:
+            timings = benchmark(function_dir, args.runs)
+        except subprocess.CalledProcessError as e:
+            print(f"{function_dir:<22} failed: {e.stderr.strip().splitlines()[-1]}")
+            continue
+        results[function_dir] = timings
+        total = timings["import"] + timings["first_call"]
+        print(
+            f"{function_dir:<22} {timings['import']:>10.1f} "
+            f"{timings['first_call']:>14.1f} {total:>9.1f}"
+        )
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(results, json.load(f))
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
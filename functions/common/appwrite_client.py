@@ -0,0 +1,161 @@
+"""Appwrite client, listing and execution helpers shared by every function
+
+Each function deploys from its own directory, so "make common" copies this
+file into all of them.
+"""
+
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import appwrite.client
+import requests
+from appwrite.client import Client
+from appwrite.query import Query
+from appwrite.services.databases import Databases
+from appwrite.services.functions import Functions
+
+PROJECT_ID = "67cccd44002cccfc9ae0"
+APPWRITE_ENDPOINT = "https://appwrite.liammasters.space/v1"
+APPWRITE_POOL_SIZE = 32
+PAGE_SIZE = int(os.getenv("LIST_PAGE_SIZE", "100"))
+WAIT_INITIAL_DELAY_S = 0.5
+WAIT_MAX_DELAY_S = 5
+
+
+_appwrite_client: Optional[Client] = None
+_appwrite_adapter: Optional[requests.adapters.HTTPAdapter] = None
+
+
+def get_client() -> Client:
+    """Get the Appwrite client for this process, creating it on first use
+
+    The Appwrite SDK sends every request through requests.request, which
+    opens a new connection each time. Pointing it at one keep-alive session
+    lets warm invocations reuse connections instead of repeating the TLS
+    handshake.
+    """
+    global _appwrite_client, _appwrite_adapter
+    if _appwrite_client is None:
+        _appwrite_adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=APPWRITE_POOL_SIZE
+        )
+        session = requests.Session()
+        session.mount("https://", _appwrite_adapter)
+        appwrite.client.requests = session
+
+        client = Client()
+        client.set_key(os.getenv("APPWRITE_API_KEY"))
+        client.set_endpoint(APPWRITE_ENDPOINT)
+        client.set_project(PROJECT_ID)
+        _appwrite_client = client
+    return _appwrite_client
+
+
+def connection_stats() -> Dict[str, int]:
+    """Count connections opened and requests sent by this process's Appwrite client"""
+    stats = {"connections": 0, "requests": 0}
+    if _appwrite_adapter is not None:
+        pools = _appwrite_adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                stats["connections"] += pool.num_connections
+                stats["requests"] += pool.num_requests
+    stats["reused"] = stats["requests"] - stats["connections"]
+    return stats
+
+
+def iter_pages(
+    list_page: Callable[[List[str]], List[Dict[str, Any]]],
+    queries: Optional[List[str]] = None,
+    page_size: int = PAGE_SIZE,
+) -> Iterator[Dict[str, Any]]:
+    """Yield every item of a listing, reading it one page at a time
+
+    Pages are read with cursorAfter rather than offset, so each page costs
+    the same however deep the scan is. The next page is read before the
+    current one is yielded, so callers can delete the items they are given
+    without invalidating the cursor.
+    """
+    queries = list(queries or [])
+    page = list_page(queries + [Query.limit(page_size)])
+    while page:
+        next_page = []
+        if len(page) == page_size:
+            next_page = list_page(
+                queries
+                + [Query.limit(page_size), Query.cursor_after(page[-1]["$id"])]
+            )
+        yield from page
+        page = next_page
+
+
+def iter_documents(
+    databases: Databases,
+    database_id: str,
+    collection_id: str,
+    queries: Optional[List[str]] = None,
+    page_size: int = PAGE_SIZE,
+) -> Iterator[Dict[str, Any]]:
+    """Yield every document in a collection that matches the queries"""
+    return iter_pages(
+        lambda page_queries: databases.list_documents(
+            database_id, collection_id, queries=page_queries
+        )["documents"],
+        queries,
+        page_size,
+    )
+
+
+def wait_for_executions(
+    functions: Functions,
+    executions: List[Tuple[str, str]],
+    deadline_s: float,
+    log: Callable,
+    workers: int = 1,
+    initial_delay_s: float = WAIT_INITIAL_DELAY_S,
+    max_delay_s: float = WAIT_MAX_DELAY_S,
+) -> Dict[str, Dict[str, Any]]:
+    """Wait for (function ID, execution ID) executions to finish
+
+    Pending executions are polled together in rounds, over up to workers
+    threads, with exponential backoff and jitter between rounds, until they
+    have all finished or deadline_s has passed. Finished executions are
+    returned by execution ID, so anything missing was still running at the
+    deadline.
+    """
+    deadline = time.monotonic() + deadline_s
+    pending = {execution_id: function_id for function_id, execution_id in executions}
+    finished = {}
+
+    def poll(item: Tuple[str, str]) -> Optional[Dict[str, Any]]:
+        execution_id, function_id = item
+        try:
+            return functions.get_execution(function_id, execution_id)
+        except Exception as e:
+            log(f"Failed to get execution {execution_id} {e}")
+            return None
+
+    delay_s = initial_delay_s
+    while pending:
+        items = list(pending.items())
+        if workers > 1 and len(items) > 1:
+            with ThreadPoolExecutor(max_workers=min(workers, len(items))) as executor:
+                results = list(executor.map(poll, items))
+        else:
+            results = [poll(item) for item in items]
+        for (execution_id, _), execution in zip(items, results):
+            if execution and execution["status"] in ("completed", "failed"):
+                finished[execution_id] = execution
+                del pending[execution_id]
+        remaining_s = deadline - time.monotonic()
+        if not pending or remaining_s <= 0:
+            break
+        time.sleep(min(remaining_s, delay_s * random.uniform(0.5, 1)))
+        delay_s = min(max_delay_s, delay_s * 2)
+    if pending:
+        log(f"{len(pending)} executions still running after {deadline_s:g}s")
+    return finished
@@ -0,0 +1,82 @@
+"""Canonical article URLs, shared by the indexer and the summary functions
+
+Kept here once and copied next to each function that imports it by
+"make common".
+"""
+
+import re
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+# Query parameters that only identify the campaign or click a link came from
+TRACKING_PARAMS = {
+    "_ga",
+    "_gl",
+    "cmpid",
+    "dclid",
+    "fbclid",
+    "gbraid",
+    "gclid",
+    "guccounter",
+    "igshid",
+    "mc_cid",
+    "mc_eid",
+    "msclkid",
+    "ncid",
+    "ocid",
+    "ref",
+    "ref_src",
+    "smid",
+    "wbraid",
+    "yclid",
+}
+TRACKING_PARAM_PREFIXES = ("utm_", "hsa_", "mkt_", "pk_")
+AMP_CACHE_PATH_RE = re.compile(r"^/[a-z]/(?:s/)?([^/]+)(/.*)?$")
+# /story/amp, /story/amp/ and /story.amp.html are AMP copies of /story
+# while a bare /amp is a page of its own
+AMP_PATH_RE = re.compile(r"(?<=[^/])(?:/amp/?|\.amp)(\.html?)?$")
+
+
+def is_tracking_param(name: str) -> bool:
+    """Check whether a query parameter only tracks where a click came from"""
+    name = name.lower()
+    return name in TRACKING_PARAMS or name.startswith(TRACKING_PARAM_PREFIXES)
+
+
+def canonicalize_url(url: str) -> str:
+    """Normalize an article URL so links to the same story get the same ID
+
+    The scheme becomes https, the host is lowercased without "www." or a
+    default port, and the fragment and tracking parameters are dropped with
+    the remaining parameters sorted. AMP variants, including Google's AMP
+    cache, map to the regular page. URLs that aren't http(s) are returned
+    unchanged.
+    """
+    url = url.strip()
+    parts = urlsplit(url)
+    if parts.scheme.lower() not in ("http", "https") or not parts.hostname:
+        return url
+    try:
+        port = parts.port
+    except ValueError:
+        return url
+    host = parts.hostname.rstrip(".")
+    path = parts.path or "/"
+    if host.endswith("cdn.ampproject.org"):
+        # https://example-com.cdn.ampproject.org/c/s/example.com/story
+        match = AMP_CACHE_PATH_RE.match(path)
+        if match:
+            host, path, port = match.group(1).lower(), match.group(2) or "/", None
+    for prefix in ("www.", "amp."):
+        if host.startswith(prefix):
+            host = host[len(prefix) :]
+    netloc = host if port in (None, 80, 443) else f"{host}:{port}"
+
+    path = AMP_PATH_RE.sub(r"\1", path) or "/"
+    query = sorted(
+        (name, value)
+        for name, value in parse_qsl(parts.query, keep_blank_values=True)
+        if not is_tracking_param(name)
+        and name.lower() != "amp"
+        and not (name == "outputType" and value == "amp")
+    )
+    return urlunsplit(("https", netloc, path, urlencode(query), ""))
@@ -0,0 +1,642 @@
+"""Feed indexing shared by the news and podcast indexers
+
+Each indexer only parses its own kind of feed, and everything around that,
+from reading the request and the feed documents to storing entries and the
+update, lives here. "make common" copies this into both indexer directories
+and the scheduler's before deploying.
+"""
+
+import datetime
+import html
+import http
+import json
+import os
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from html.parser import HTMLParser
+from itertools import chain, zip_longest
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+from urllib.parse import urlsplit
+
+import requests
+from appwrite.exception import AppwriteException
+from appwrite.query import Query
+from appwrite.services.databases import Databases
+from pydantic import BaseModel, Field, PositiveInt
+
+from appwrite_client import connection_stats, get_client
+
+FEEDS_DATABASE_ID = "6466af38420c3ca601c1"
+LOOKUP_BATCH_SIZE = 100
+MAX_DESCRIPTION_LENGTH = 4096
+WRITE_WORKERS = int(os.getenv("INDEX_WRITE_WORKERS", "1"))
+FEED_WORKERS = int(os.getenv("INDEX_FEED_WORKERS", "8"))
+FEED_CONNECT_TIMEOUT_S = 10
+FEED_READ_TIMEOUT_S = 30
+FEED_USER_AGENT = "feedparser/6.0.11 +https://github.com/kurtmckee/feedparser/"
+FEED_ATTRIBUTES = [
+    "$id",
+    "rss_url",
+    "etag",
+    "last_modified",
+    "high_water_pub_date",
+    "high_water_guid",
+    "high_water_out_of_order",
+    "update_interval_minutes",
+    "publish_gap_minutes",
+    "consecutive_failures",
+    "content_hash",
+]
+ASCII_SPACES = " \n\t\f\r"
+# Concurrent fetches from one host. The scheduler shares this out between the
+# executions a host's due feeds are split over, so it caps what a publisher
+# sees at once
+MAX_FEEDS_PER_HOST = int(os.getenv("MAX_FEEDS_PER_HOST", "4"))
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "3"))
+BREAKER_COOLDOWN_MINUTES = int(os.getenv("BREAKER_COOLDOWN_MINUTES", "60"))
+BREAKER_MAX_COOLDOWN_MINUTES = 7 * 24 * 60
+
+
+class HighWaterMark(BaseModel):
+    """Model for the newest entry indexed from a feed
+
+    A feed last seen out of order has no usable mark, only out_of_order set,
+    so every poll scans it in full until it is seen in order again.
+    """
+
+    pub_date: Optional[datetime.datetime] = Field(default=None)
+    guid: Optional[str] = Field(default=None)
+    out_of_order: bool = Field(default=False)
+
+
+class ServerRequest(BaseModel):
+    """Model for client request to serverless function"""
+
+    feed_id: Optional[str] = Field(default=None)
+    feed_ids: List[str] = Field(default_factory=list)
+    write_workers: int = Field(default=WRITE_WORKERS, ge=1)
+    feed_workers: int = Field(default=FEED_WORKERS, ge=1)
+    # Concurrent fetches per host, for hosts whose feeds the scheduler split
+    # over several executions
+    host_limits: Dict[str, PositiveInt] = Field(default_factory=dict)
+
+    def all_feed_ids(self) -> List[str]:
+        """Get the IDs of every feed to index, without duplicates"""
+        feed_ids = [self.feed_id] if self.feed_id else []
+        return list(dict.fromkeys(feed_ids + self.feed_ids))
+
+
+class FeedSourceRes(BaseModel):
+    """Response model for an indexed feed"""
+
+    status: http.HTTPStatus = Field(default=http.HTTPStatus.OK)
+    etag: Optional[str] = Field(default=None)
+    last_modified: Optional[str] = Field(default=None)
+    high_water_mark: Optional[HighWaterMark] = Field(default=None)
+    new_items: int = Field(default=0)
+    publish_gap_minutes: Optional[int] = Field(default=None)
+    fetch_failed: bool = Field(default=False)
+    fetch_ms: Optional[int] = Field(default=None)
+    content_hash: Optional[str] = Field(default=None)
+
+
+feed_session = requests.Session()
+
+
+class _TextLimitReached(Exception):
+    """Raised to stop parsing once enough text has been collected"""
+
+
+class _TextExtractor(HTMLParser):
+    """Collects the text of an HTML fragment the same way as
+    BeautifulSoup(markup, "html.parser").get_text(separator=" ")"""
+
+    def __init__(self, limit: Optional[int]):
+        super().__init__(convert_charrefs=True)
+        self.limit = limit
+        self.parts: List[str] = []
+        self.length = -1
+        self.pending: List[str] = []
+        self.skip_depth = 0
+        self.preserve_depth = 0
+
+    def flush(self):
+        """Finish the current run of text, stopping once the limit is reached"""
+        if not self.pending:
+            return
+        text = "".join(self.pending)
+        self.pending = []
+        if self.skip_depth:
+            return
+        if not self.preserve_depth and not text.strip(ASCII_SPACES):
+            text = "\n" if "\n" in text else " "
+        self.parts.append(text)
+        self.length += len(text) + 1
+        if self.limit is not None and self.length >= self.limit:
+            raise _TextLimitReached()
+
+    def handle_starttag(self, tag, attrs):
+        self.flush()
+        if tag in ("script", "style"):
+            self.skip_depth += 1
+        elif tag in ("pre", "textarea"):
+            self.preserve_depth += 1
+
+    def handle_endtag(self, tag):
+        self.flush()
+        if tag in ("script", "style") and self.skip_depth:
+            self.skip_depth -= 1
+        elif tag in ("pre", "textarea") and self.preserve_depth:
+            self.preserve_depth -= 1
+
+    def handle_startendtag(self, tag, attrs):
+        self.flush()
+
+    def handle_data(self, data):
+        self.pending.append(data)
+
+    def handle_comment(self, data):
+        self.flush()
+
+    def handle_decl(self, decl):
+        self.flush()
+
+    def handle_pi(self, data):
+        self.flush()
+
+    def unknown_decl(self, data):
+        self.flush()
+        if data.startswith("CDATA["):
+            self.pending.append(data[len("CDATA[") :])
+            self.flush()
+
+
+def html_to_text(markup: str, limit: Optional[int] = None) -> str:
+    """Strip tags and decode entities in an HTML fragment
+
+    Parsing stops as soon as limit characters of text have been collected,
+    and markup without any tags skips the parser entirely.
+    """
+    if "<" not in markup:
+        text = html.unescape(markup) if "&" in markup else markup
+        if text and not text.strip(ASCII_SPACES):
+            text = "\n" if "\n" in text else " "
+        return text[:limit]
+    parser = _TextExtractor(limit)
+    try:
+        parser.feed(markup)
+        parser.close()
+        parser.flush()
+    except _TextLimitReached:
+        pass
+    return " ".join(parser.parts)[:limit]
+
+
+def aggregate_responses(responses: Iterable[http.HTTPStatus]) -> http.HTTPStatus:
+    """Combine per-item responses into a single response status"""
+    responses = list(responses)
+    if all(res == http.HTTPStatus.INTERNAL_SERVER_ERROR for res in responses):
+        return http.HTTPStatus.INTERNAL_SERVER_ERROR
+    elif any(res == http.HTTPStatus.INTERNAL_SERVER_ERROR for res in responses):
+        return http.HTTPStatus.PARTIAL_CONTENT
+    elif all(res == http.HTTPStatus.CONFLICT for res in responses):
+        return http.HTTPStatus.CONFLICT
+    return http.HTTPStatus.OK
+
+
+def entry_published(entry: Dict) -> Optional[datetime.datetime]:
+    """Get an entry's pub date as an aware datetime, if it has a valid one"""
+    if parsed := entry.get("published_parsed"):
+        return datetime.datetime(*parsed[:6], tzinfo=datetime.timezone.utc)
+    try:
+        published = parsedate_to_datetime(entry.get("published") or "")
+    except (TypeError, ValueError):
+        return None
+    if published.tzinfo is None:
+        published = published.replace(tzinfo=datetime.timezone.utc)
+    return published
+
+
+def entry_guid(entry: Dict) -> Optional[str]:
+    """Get the identifier a feed gives an entry, falling back to its first link"""
+    if entry.get("id"):
+        return entry["id"]
+    if entry.get("link"):
+        return entry["link"]
+    for link in entry.get("links") or []:
+        if link.get("href"):
+            return link["href"]
+    return None
+
+
+class HighWaterMarkScan:
+    """Walk a feed's entries, newest first, until reaching its high-water mark
+
+    The mark is only trusted while the entries seen so far are in pub date
+    order, and never for a feed that was out of order when last indexed.
+    Otherwise every remaining entry is scanned and the existence lookup
+    decides what is new.
+    """
+
+    def __init__(self, mark: HighWaterMark):
+        self.mark = mark
+        self.in_order = True
+        self.reached = False
+        self.writes_failed = False
+        self.newest = HighWaterMark()
+        self.previous: Optional[datetime.datetime] = None
+        self.published_dates: Set[datetime.datetime] = set()
+
+    def check_order(self, published: Optional[datetime.datetime]):
+        """Record an entry's pub date, noting whether it breaks newest-first order"""
+        if published is None:
+            return
+        self.published_dates.add(published)
+        if self.previous is not None and published > self.previous:
+            self.in_order = False
+        self.previous = published
+
+    @property
+    def trusts_order(self) -> bool:
+        """Whether entries can be taken as newest first, so the scan may stop"""
+        return self.in_order and not self.mark.out_of_order
+
+    def check_feed_order(self, entries: List[Dict]):
+        """Check the order of every entry up front, before the scan starts"""
+        for entry in entries:
+            self.check_order(entry_published(entry))
+        self.previous = None
+
+    def reached_mark(self, entry: Dict) -> bool:
+        """Check whether an entry is at or behind the mark, or record it as unseen"""
+        guid = entry_guid(entry)
+        published = entry_published(entry)
+        self.check_order(published)
+        if self.trusts_order and (
+            (guid is not None and guid == self.mark.guid)
+            or (
+                published is not None
+                and self.mark.pub_date is not None
+                and published < self.mark.pub_date
+            )
+        ):
+            self.reached = True
+            return True
+
+        if published is not None and (
+            self.newest.pub_date is None or published > self.newest.pub_date
+        ):
+            self.newest = HighWaterMark(pub_date=published, guid=guid)
+        elif self.newest.pub_date is None and self.newest.guid is None:
+            self.newest = HighWaterMark(guid=guid)
+        return False
+
+    def publish_gap_minutes(self) -> Optional[int]:
+        """Median minutes between consecutive pub dates seen so far and the mark"""
+        dates = set(self.published_dates)
+        if self.mark.pub_date is not None:
+            dates.add(self.mark.pub_date)
+        dates = sorted(dates)
+        gaps = [
+            (later - earlier).total_seconds() / 60
+            for earlier, later in zip(dates, dates[1:])
+        ]
+        if not gaps:
+            return None
+        return max(1, round(statistics.median(gaps)))
+
+    def next_mark(self) -> Optional[HighWaterMark]:
+        """Get the mark to store after the scan, or None to keep the current one
+
+        A feed found out of order gets no mark, only the flag, since the
+        newest entry says nothing about where the next poll can stop.
+        """
+        if not self.in_order:
+            return HighWaterMark(out_of_order=True)
+        if self.writes_failed:
+            return None
+        if self.newest.pub_date is None and self.newest.guid is None:
+            return None
+        if (
+            self.mark.pub_date is not None
+            and self.newest.pub_date is not None
+            and self.newest.pub_date < self.mark.pub_date
+        ):
+            return None
+        return self.newest
+
+
+def breaker_open_until(
+    failures: int, now: datetime.datetime
+) -> Optional[datetime.datetime]:
+    """Get when a feed's circuit breaker closes after consecutive fetch failures
+
+    The breaker opens once a feed fails BREAKER_FAILURE_THRESHOLD times in a
+    row, and the cooldown doubles with every further failure. None means the
+    breaker is closed.
+    """
+    if failures < BREAKER_FAILURE_THRESHOLD:
+        return None
+    cooldown = BREAKER_COOLDOWN_MINUTES * 2 ** (failures - BREAKER_FAILURE_THRESHOLD)
+    return now + datetime.timedelta(
+        minutes=min(cooldown, BREAKER_MAX_COOLDOWN_MINUTES)
+    )
+
+
+def feed_host(feed: Dict[str, Any]) -> str:
+    """Get the host a feed is fetched from"""
+    return (urlsplit(feed.get("rss_url") or "").hostname or "").lower()
+
+
+def interleave_by_host(feed_ids: List[str], hosts: Dict[str, str]) -> List[str]:
+    """Order feed IDs taking one from each host in turn
+
+    Workers then spread over hosts instead of all waiting on one host's
+    limit while other hosts' feeds queue behind them.
+    """
+    by_host: Dict[str, List[str]] = {}
+    for feed_id in feed_ids:
+        by_host.setdefault(hosts.get(feed_id, ""), []).append(feed_id)
+    return [
+        feed_id
+        for feed_id in chain.from_iterable(zip_longest(*by_host.values()))
+        if feed_id is not None
+    ]
+
+
+def create_document(
+    databases: Databases,
+    collection_id: str,
+    document_id: str,
+    item: BaseModel,
+    log: Callable,
+) -> http.HTTPStatus:
+    """Create a document for a parsed entry"""
+    try:
+        databases.create_document(
+            FEEDS_DATABASE_ID,
+            collection_id,
+            document_id,
+            item.model_dump(exclude_none=True),
+        )
+    except AppwriteException as e:
+        log(f"Failed to create document {document_id} {e}")
+        if e.code == http.HTTPStatus.CONFLICT:
+            return http.HTTPStatus.CONFLICT
+        return http.HTTPStatus.INTERNAL_SERVER_ERROR
+    except Exception as e:
+        log(f"Failed to create document {document_id} {e}")
+        return http.HTTPStatus.INTERNAL_SERVER_ERROR
+    return http.HTTPStatus.OK
+
+
+def create_documents(
+    databases: Databases,
+    collection_id: str,
+    items: List[Tuple[str, BaseModel]],
+    log: Callable,
+    write_workers: int = 1,
+) -> List[http.HTTPStatus]:
+    """Create documents for parsed entries, using up to write_workers threads
+
+    Responses are returned in the same order as the entries.
+    """
+    if write_workers <= 1 or len(items) <= 1:
+        return [
+            create_document(databases, collection_id, document_id, item, log)
+            for document_id, item in items
+        ]
+    with ThreadPoolExecutor(max_workers=min(write_workers, len(items))) as executor:
+        return list(
+            executor.map(
+                lambda entry: create_document(
+                    databases, collection_id, entry[0], entry[1], log
+                ),
+                items,
+            )
+        )
+
+
+def find_existing_document_ids(
+    databases: Databases, collection_id: str, document_ids: List[str], log: Callable
+) -> Set[str]:
+    """Look up which of the given document IDs already exist in a collection"""
+    existing_ids = set()
+    for start in range(0, len(document_ids), LOOKUP_BATCH_SIZE):
+        batch = document_ids[start : start + LOOKUP_BATCH_SIZE]
+        try:
+            res = databases.list_documents(
+                FEEDS_DATABASE_ID,
+                collection_id,
+                queries=[
+                    Query.equal("$id", batch),
+                    Query.select(["$id"]),
+                    Query.limit(len(batch)),
+                ],
+            )
+        except Exception as e:
+            log(f"Failed to look up existing documents {e}")
+            continue
+        existing_ids.update(document["$id"] for document in res["documents"])
+    return existing_ids
+
+
+def get_feed_documents(
+    databases: Databases, collection_id: str, feed_ids: List[str]
+) -> Dict[str, Dict[str, Any]]:
+    """Load the feed documents for the given IDs, one query per batch of IDs"""
+    feeds = {}
+    for start in range(0, len(feed_ids), LOOKUP_BATCH_SIZE):
+        batch = feed_ids[start : start + LOOKUP_BATCH_SIZE]
+        res = databases.list_documents(
+            FEEDS_DATABASE_ID,
+            collection_id,
+            queries=[
+                Query.equal("$id", batch),
+                Query.select(FEED_ATTRIBUTES),
+                Query.limit(len(batch)),
+            ],
+        )
+        feeds.update({feed["$id"]: feed for feed in res["documents"]})
+    return feeds
+
+
+def index_feed(
+    feed: Dict[str, Any],
+    databases: Databases,
+    log: Callable,
+    write_workers: int,
+    collection_id: str,
+    fetch_source: Callable[..., FeedSourceRes],
+    default_update_interval_minutes: int,
+) -> http.HTTPStatus:
+    """Index a single feed with fetch_source and record the update on its
+    document in collection_id"""
+    start = time.perf_counter()
+    try:
+        res = fetch_source(
+            feed["rss_url"],
+            databases,
+            feed["$id"],
+            log,
+            etag=feed.get("etag"),
+            last_modified=feed.get("last_modified"),
+            high_water_mark=HighWaterMark(
+                pub_date=feed.get("high_water_pub_date"),
+                guid=feed.get("high_water_guid"),
+                out_of_order=feed.get("high_water_out_of_order") or False,
+            ),
+            write_workers=write_workers,
+            content_hash=feed.get("content_hash"),
+        )
+    except Exception as e:  # pylint: disable=broad-except
+        log(f"Exception occurred fetching data {e}")
+        res = FeedSourceRes(
+            status=http.HTTPStatus.INTERNAL_SERVER_ERROR, fetch_failed=True
+        )
+
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    update_interval = feed.get("update_interval_minutes")
+    if update_interval is None:
+        update_interval = default_update_interval_minutes
+    # The scheduler only queries for feeds whose next_update_at has passed
+    next_update = now + datetime.timedelta(minutes=update_interval)
+    failures = 0
+    if res.fetch_failed:
+        failures = (feed.get("consecutive_failures") or 0) + 1
+    open_until = breaker_open_until(failures, now)
+    if open_until is not None:
+        log(f"Feed failed {failures} times in a row, pausing until {open_until}")
+        next_update = max(next_update, open_until)
+    feed_update = {
+        "last_update": now.strftime("%Y-%m-%dT%H:%M:%S.%f%z"),
+        "next_update_at": next_update.strftime("%Y-%m-%dT%H:%M:%S.%f%z"),
+        # Read by the scheduler to balance feeds across index executions
+        "last_index_ms": round((time.perf_counter() - start) * 1000),
+        "consecutive_failures": failures,
+        # Read by the scheduler to report each feed's result
+        "last_status": int(res.status),
+        "breaker_open_until": open_until
+        and open_until.strftime("%Y-%m-%dT%H:%M:%S.%f%z"),
+    }
+    if res.fetch_ms is not None:
+        feed_update["fetch_latency_ms"] = res.fetch_ms
+    if res.status in (http.HTTPStatus.OK, http.HTTPStatus.CONFLICT):
+        feed_update["etag"] = res.etag
+        feed_update["last_modified"] = res.last_modified
+        # Only after every entry was stored, so failed writes are retried on
+        # the next poll. A 304 isn't hashed, keep the digest of the body it
+        # says is unchanged
+        if res.content_hash is not None:
+            feed_update["content_hash"] = res.content_hash
+    if res.status != http.HTTPStatus.INTERNAL_SERVER_ERROR:
+        # Read by the scheduler to adapt update_interval_minutes
+        feed_update["last_new_items"] = res.new_items
+        if res.publish_gap_minutes is not None:
+            previous_gap = feed.get("publish_gap_minutes")
+            feed_update["publish_gap_minutes"] = (
+                res.publish_gap_minutes
+                if previous_gap is None
+                else round((previous_gap + res.publish_gap_minutes) / 2)
+            )
+    # Only set when every new entry was read and stored, entries that failed
+    # to parse would fail again and shouldn't hold the mark back
+    if res.high_water_mark is not None:
+        pub_date = res.high_water_mark.pub_date
+        feed_update["high_water_pub_date"] = pub_date and pub_date.isoformat()
+        feed_update["high_water_guid"] = res.high_water_mark.guid
+        feed_update["high_water_out_of_order"] = res.high_water_mark.out_of_order
+    try:
+        databases.update_document(
+            FEEDS_DATABASE_ID,
+            collection_id,
+            feed["$id"],
+            feed_update,
+        )
+    except Exception as e:  # pylint: disable=broad-except
+        log(f"Failed to update feed document {feed['$id']} {e}")
+    return res.status
+
+
+def index_feeds(
+    context,
+    collection_id: str,
+    fetch_source: Callable[..., FeedSourceRes],
+    default_update_interval_minutes: int,
+    feed_kind: str,
+):
+    """Index the feeds in a request, responding with each feed's status
+
+    Feeds are indexed concurrently, at most MAX_FEEDS_PER_HOST from one host
+    at once unless the request's host_limits sets a host's limit.
+    """
+
+    def log(message):
+        context.log(f"{datetime.datetime.now().strftime('%H:%M:%S')}: {message}")
+
+    log("Starting parsing request")
+    req_body = json.loads(context.req.body)
+    log(f"Got request body {req_body}")
+    req_data = ServerRequest(**req_body)
+
+    client = get_client()
+    log(f"Appwrite connections in this process {connection_stats()}")
+
+    databases = Databases(client)
+
+    feed_ids = req_data.all_feed_ids()
+    if not feed_ids:
+        log("No feed IDs in request")
+        return context.res.json(
+            {"message": "feed_id or feed_ids is required"},
+            statusCode=http.HTTPStatus.BAD_REQUEST,
+        )
+
+    log(f"Fetching {len(feed_ids)} {feed_kind} feeds...")
+    try:
+        feeds = get_feed_documents(databases, collection_id, feed_ids)
+    except Exception as e:
+        log(f"Failed to fetch feed documents {feed_ids} {e}")
+        return context.res.json(
+            {"message": str(e)}, statusCode=http.HTTPStatus.INTERNAL_SERVER_ERROR
+        )
+
+    hosts = {feed_id: feed_host(feed) for feed_id, feed in feeds.items()}
+    host_limits = {
+        host: threading.BoundedSemaphore(
+            req_data.host_limits.get(host, MAX_FEEDS_PER_HOST)
+        )
+        for host in set(hosts.values())
+    }
+
+    def index_feed_id(feed_id: str) -> http.HTTPStatus:
+        feed = feeds.get(feed_id)
+        if feed is None:
+            log(f"Feed document {feed_id} not found")
+            return http.HTTPStatus.INTERNAL_SERVER_ERROR
+        feed_log = log if len(feed_ids) == 1 else lambda m: log(f"[{feed_id}] {m}")
+        with host_limits[hosts[feed_id]]:
+            return index_feed(
+                feed,
+                databases,
+                feed_log,
+                req_data.write_workers,
+                collection_id,
+                fetch_source,
+                default_update_interval_minutes,
+            )
+
+    feed_ids = interleave_by_host(feed_ids, hosts)
+    feed_workers = min(req_data.feed_workers, len(feed_ids))
+    with ThreadPoolExecutor(max_workers=feed_workers) as executor:
+        feed_statuses = dict(zip(feed_ids, executor.map(index_feed_id, feed_ids)))
+
+    status = aggregate_responses(feed_statuses.values())
+    log("Finished fetching data")
+    return context.res.json(
+        {"feeds": {feed_id: int(res) for feed_id, res in feed_statuses.items()}},
+        statusCode=status,
+    )
@@ -0,0 +1,172 @@
+"""Gemini summaries and their leases, shared by summarize_article and
+presummarize_articles
+
+"make common" copies this into both function directories, along with
+get_article, which extract_article_text downloads articles with.
+"""
+
+import datetime
+import os
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from appwrite.exception import AppwriteException
+from appwrite.services.databases import Databases
+
+FEEDS_DATABASE_ID = "6466af38420c3ca601c1"
+SUMMARY_LEASES_COLLECTION_ID = "summary_leases"
+# Longer than the summarize_article timeout, so a lease left by a crashed
+# request expires
+SUMMARY_LEASE_S = 60
+SUMMARY_DOWNLOAD_S = float(os.getenv("SUMMARY_DOWNLOAD_S", "10"))
+# "extracted" sends the article text inline, "url" leaves Gemini to find it
+SUMMARY_MODE = os.getenv("SUMMARY_MODE", "extracted")
+SUMMARY_MODEL = "gemini-2.5-flash-lite"
+SUMMARY_INPUT_TOKENS = int(os.getenv("SUMMARY_INPUT_TOKENS", "6000"))
+# Rough size of a token in English text, close enough to budget input
+CHARS_PER_TOKEN = 4
+# Less text than this is usually a paywall or cookie notice, not the article
+MIN_ARTICLE_WORDS = 100
+SUMMARY_INSTRUCTIONS = (
+    "Summarize the following article, highlighting the main points "
+    "and providing key takeaways. Keep the summary to one paragraph to make it "
+    "digestible for readers, breaking it up into bullet points. Avoid any prose "
+    "that isn't directly summarizing the article. Return the summary formatted "
+    "as markdown"
+)
+
+
+def acquire_summary_lease(databases: Databases, url_hash: str, log: Callable) -> bool:
+    """Try to take the lease on generating an article's summary
+
+    The lease is a document keyed by the URL hash, so only one request can
+    create it. A lease past its expiry was left by a request that died and
+    is taken over. If leases can't be used at all the request is allowed to
+    generate, so summaries never depend on them.
+    """
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    expires_at = now + datetime.timedelta(seconds=SUMMARY_LEASE_S)
+    lease = {"expires_at": expires_at.strftime("%Y-%m-%dT%H:%M:%S.%f%z")}
+    try:
+        databases.create_document(
+            FEEDS_DATABASE_ID, SUMMARY_LEASES_COLLECTION_ID, url_hash, lease
+        )
+        return True
+    except AppwriteException as e:
+        if e.code != 409:
+            log(f"Failed to take summary lease, generating without it: {e}")
+            return True
+
+    try:
+        current = databases.get_document(
+            FEEDS_DATABASE_ID, SUMMARY_LEASES_COLLECTION_ID, url_hash
+        )
+    except AppwriteException:
+        # Released since the create failed, take it on the next try
+        return False
+    if datetime.datetime.fromisoformat(current["expires_at"]) > now:
+        return False
+
+    log("Summary lease expired, taking it over")
+    try:
+        databases.delete_document(
+            FEEDS_DATABASE_ID, SUMMARY_LEASES_COLLECTION_ID, url_hash
+        )
+    except AppwriteException:
+        pass
+    try:
+        databases.create_document(
+            FEEDS_DATABASE_ID, SUMMARY_LEASES_COLLECTION_ID, url_hash, lease
+        )
+        return True
+    except AppwriteException:
+        return False
+
+
+def release_summary_lease(databases: Databases, url_hash: str, log: Callable):
+    """Release the lease so waiting requests stop waiting on this one"""
+    try:
+        databases.delete_document(
+            FEEDS_DATABASE_ID, SUMMARY_LEASES_COLLECTION_ID, url_hash
+        )
+    except AppwriteException as e:
+        log(f"Failed to release summary lease: {e}")
+
+
+def trim_to_token_budget(text: str, max_tokens: int) -> str:
+    """Cut text to roughly max_tokens, at a paragraph or word boundary"""
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return text
+    text = text[:max_chars]
+    boundary = text.rfind("\n\n")
+    if boundary < max_chars // 2:
+        boundary = text.rfind(" ")
+    return text[:boundary] if boundary > 0 else text
+
+
+def extract_article_text(
+    article_url: str,
+    log: Callable,
+    max_tokens: int = SUMMARY_INPUT_TOKENS,
+    use_cache: bool = True,
+    download_s: float = SUMMARY_DOWNLOAD_S,
+) -> Tuple[Optional[str], str]:
+    """Download an article and extract its readable text, trimmed to max_tokens
+
+    Returns the text, or None when too little is found to summarize from,
+    and the URL the download ended at after redirects. Unless use_cache is
+    False the article comes from the cache shared with reader view. The
+    download takes at most download_s.
+    """
+    # Imported here since BeautifulSoup is slow to load and cached summaries
+    # don't need it
+    from get_article import fetch_article_content, get_article_content
+
+    if use_cache:
+        res = get_article_content(article_url, log, download_s)
+    else:
+        res = fetch_article_content(article_url, download_s=download_s)
+    final_url = res.url or article_url
+    if not res.data:
+        return None, final_url
+    text = "\n\n".join(block.content for block in res.data.tags)
+    if len(text.split()) < MIN_ARTICLE_WORDS:
+        return None, final_url
+    return trim_to_token_budget(text, max_tokens), final_url
+
+
+def build_summary_request(
+    article_url: str, article_text: Optional[str]
+) -> Dict[str, Any]:
+    """Build the generate_content arguments for summarizing an article
+
+    With the article text the request is self-contained. Without it Gemini
+    is given the URL and search grounding to find the article itself.
+    """
+    from google.genai import types
+
+    if article_text is not None:
+        return {
+            "model": SUMMARY_MODEL,
+            "contents": f"{SUMMARY_INSTRUCTIONS}\n\n{article_text}",
+        }
+    grounding_tool = types.Tool(google_search=types.GoogleSearch())
+    return {
+        "model": SUMMARY_MODEL,
+        "contents": f"{SUMMARY_INSTRUCTIONS}\n\n {article_url}",
+        "config": types.GenerateContentConfig(tools=[grounding_tool]),
+    }
+
+
+def request_summary(
+    article_url: str, article_text: Optional[str]
+) -> Tuple[Optional[str], Any]:
+    """Summarize an article with Gemini, returning the text and usage metadata"""
+    # Imported here since it's slow to load and cached summaries don't need it
+    from google import genai
+
+    client = genai.Client(api_key=os.getenv("GOOGLE_GEMINI_API_KEY"))
+    response = client.models.generate_content(
+        **build_summary_request(article_url, article_text)
+    )
+    return response.text, response.usage_metadata
@@ -0,0 +1,92 @@
+"""Shared fixtures for the offline function tests
+
+Functions import their modules by name from their own directory, with the
+shared modules copied in by "make common". Tests put functions/common and
+each function directory on the import path to match.
+"""
+
+import json
+import os
+import sys
+from typing import Any, Dict, List, Optional, Tuple
+
+import pytest
+
+FUNCTIONS_DIR = os.path.dirname(os.path.abspath(__file__))
+for name in sorted(os.listdir(FUNCTIONS_DIR), reverse=True):
+    path = os.path.join(FUNCTIONS_DIR, name)
+    if os.path.isdir(path) and not name.startswith(("_", ".")):
+        sys.path.insert(0, path)
+# Ahead of any stale copies left in the function directories
+sys.path.insert(0, os.path.join(FUNCTIONS_DIR, "common"))
+
+
+class FakeDatabases:
+    """In-memory stand-in for appwrite's Databases service
+
+    Only the calls the functions make are supported, and list_documents
+    only understands equal and limit queries.
+    """
+
+    def __init__(self):
+        self.documents: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self.created: List[str] = []
+
+    def create_document(
+        self, database_id: str, collection_id: str, document_id: str, data: Dict
+    ):
+        from appwrite.exception import AppwriteException
+
+        if (collection_id, document_id) in self.documents:
+            raise AppwriteException("Document already exists", 409)
+        self.documents[(collection_id, document_id)] = {"$id": document_id, **data}
+        self.created.append(document_id)
+        return self.documents[(collection_id, document_id)]
+
+    def update_document(
+        self, database_id: str, collection_id: str, document_id: str, data: Dict
+    ):
+        document = self.documents.setdefault(
+            (collection_id, document_id), {"$id": document_id}
+        )
+        document.update(data)
+        return document
+
+    def get_document(
+        self,
+        database_id: str,
+        collection_id: str,
+        document_id: str,
+        queries: Optional[List[str]] = None,
+    ):
+        from appwrite.exception import AppwriteException
+
+        if (collection_id, document_id) not in self.documents:
+            raise AppwriteException("Document not found", 404)
+        return self.documents[(collection_id, document_id)]
+
+    def list_documents(
+        self, database_id: str, collection_id: str, queries: List[str] = None
+    ):
+        documents = [
+            document
+            for (collection, _), document in self.documents.items()
+            if collection == collection_id
+        ]
+        limit = None
+        for query in map(json.loads, queries or []):
+            if query["method"] == "equal":
+                documents = [
+                    document
+                    for document in documents
+                    if document.get(query["attribute"]) in query["values"]
+                ]
+            elif query["method"] == "limit":
+                limit = query["values"][0]
+        return {"total": len(documents), "documents": documents[:limit]}
+
+
+@pytest.fixture
+def databases() -> FakeDatabases:
+    return FakeDatabases()
+
@@ -6,7 +6,6 @@ import datetime
 import traceback
 from typing import Optional
 
-from appwrite.client import Client
 from appwrite.id import ID
 from appwrite.input_file import InputFile
 from appwrite.permission import Permission
@@ -15,9 +14,9 @@ from appwrite.role import Role
 from appwrite.services.databases import Databases
 from appwrite.services.storage import Storage
 from pydantic import BaseModel, Field
-from google import genai
 
-PROJECT_ID = "67cccd44002cccfc9ae0"
+from appwrite_client import connection_stats, get_client, iter_documents
+
 FEEDS_DATABASE_ID = "6466af38420c3ca601c1"
 SUBSCRIPTIONS_COLLECTION_ID = "6797b43c001f4e9c95a0"
 NEWS_ARTICLES_COLLECTION_ID = "6797ac2e001706792636"
@@ -35,6 +34,9 @@ class ServerRequest(BaseModel):
 def extract_topics_from_articles(context, articles, summaries):
     """Use Gemini LLM to extract 3-7 key topics from articles."""
     try:
+        # Imported here so runs without any digests to write skip loading it
+        from google import genai
+
         client = genai.Client(api_key=os.getenv("GOOGLE_GEMINI_API_KEY"))
         # grounding_tool = types.Tool(google_search=types.GoogleSearch())
         # config = types.GenerateContentConfig(tools=[grounding_tool])
@@ -137,41 +139,26 @@ def main(context):
     """Generate daily digests for all users with daily_digest enabled."""
     context.log("Starting daily digest generation")
 
-    appwrite_client = Client()
-    appwrite_client.set_key(os.getenv("APPWRITE_API_KEY"))
-    appwrite_client.set_endpoint("https://appwrite.liammasters.space/v1")
-    appwrite_client.set_project(PROJECT_ID)
+    appwrite_client = get_client()
+    context.log(f"Appwrite connections in this process {connection_stats()}")
 
     databases = Databases(appwrite_client)
     storage = Storage(appwrite_client)
 
     # Get all users with daily_digest enabled
     users_with_digest = []
-    page_size = 100
-    offset = 0
-    num_results = 100
 
     context.log("Querying users with daily_digest enabled")
-    while num_results >= page_size:
-        try:
-            res = databases.list_documents(
-                FEEDS_DATABASE_ID,
-                SUBSCRIPTIONS_COLLECTION_ID,
-                queries=[
-                    Query.equal("daily_digest", True),
-                    Query.limit(page_size),
-                    Query.offset(offset),
-                ],
-            )
-            if res and isinstance(res, dict) and res.get("documents"):
-                users_with_digest.extend(res["documents"])
-                num_results = len(res["documents"])
-                offset += page_size
-            else:
-                break
-        except Exception as e:
-            context.log(f"Error querying subscriptions: {e}")
-            break
+    try:
+        for user_sub in iter_documents(
+            databases,
+            FEEDS_DATABASE_ID,
+            SUBSCRIPTIONS_COLLECTION_ID,
+            [Query.equal("daily_digest", True)],
+        ):
+            users_with_digest.append(user_sub)
+    except Exception as e:
+        context.log(f"Error querying subscriptions: {e}")
 
     context.log(f"Found {len(users_with_digest)} users with daily_digest enabled")
 
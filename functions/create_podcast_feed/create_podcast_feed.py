@@ -2,22 +2,22 @@ import datetime
 import http
 import json
 import os
-import time
 from hashlib import md5
 from typing import Callable, Optional
 
 import feedparser
-from appwrite.client import Client
 from appwrite.services.databases import Databases
 from appwrite.services.functions import Functions
 from pydantic import BaseModel, Field
 
-PROJECT_ID = "67cccd44002cccfc9ae0"
+from appwrite_client import connection_stats, get_client, wait_for_executions
+
 FEEDS_DATABASE_ID = "6466af38420c3ca601c1"
 PODCAST_FEEDS_COLLECTION_ID = "6797ac11003778ff768a"
 PODCAST_EPISODES_COLLECTION_ID = "6797ac2700062e762fdd"
 INDEX_PODCAST_FUNCTION_ID = "679fe0e256c67950d62e"
 SUBSCRIPTIONS_COLLECTION_ID = "6797b43c001f4e9c95a0"
+RESULT_WAIT_S = float(os.getenv("RESULT_WAIT_S", "780"))
 
 
 class ServerRequest(BaseModel):
@@ -95,10 +95,8 @@ def main(context):
     log(f"Got request body {req_body}")
     req_data = ServerRequest(**req_body)
 
-    client = Client()
-    client.set_key(os.getenv("APPWRITE_API_KEY"))
-    client.set_endpoint("https://appwrite.liammasters.space/v1")
-    client.set_project(PROJECT_ID)
+    client = get_client()
+    log(f"Appwrite connections in this process {connection_stats()}")
 
     databases = Databases(client)
     functions = Functions(client)
@@ -132,14 +130,16 @@ def main(context):
     )
     execution_id = execution["$id"]
 
-    execution_completed = False
-    while not execution_completed:
-        execution = functions.get_execution(
-            INDEX_PODCAST_FUNCTION_ID,
-            execution_id,
-        )
-        execution_completed = execution["status"] in ("completed", "failed")
-        log(f"Execution status: {execution['status']}")
+    execution = wait_for_executions(
+        functions, [(INDEX_PODCAST_FUNCTION_ID, execution_id)], RESULT_WAIT_S, log
+    ).get(execution_id)
+    if execution is None:
+        log("Feed is still being parsed, keeping feed record")
+        if req_data.subscriptions_id:
+            log(f"Adding feed to subscriptions {req_data.subscriptions_id}")
+            add_feed_to_subscriptions(databases, req_data.subscriptions_id, document_id)
+        return context.res.json({}, statusCode=http.HTTPStatus.ACCEPTED)
+    log(f"Execution status: {execution['status']}")
 
     if execution["status"] == "completed":
         res_status = execution["responseStatusCode"]
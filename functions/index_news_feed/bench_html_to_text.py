@@ -0,0 +1,81 @@
+"""Benchmark html_to_text against the BeautifulSoup path it replaced
+
+Compares speed and output for every title and description in the feed
+fixtures. BeautifulSoup is only needed for this comparison, install it with
+`pip install beautifulsoup4` before running.
+
+Usage: python bench_html_to_text.py [feed.xml ...]
+"""
+
+import glob
+import os
+import sys
+import time
+
+import feedparser
+from bs4 import BeautifulSoup
+
+from index_news_feed import MAX_DESCRIPTION_LENGTH, html_to_text
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+REPEATS = 20
+
+
+def soup_to_text(markup: str, limit=None) -> str:
+    """The previous BeautifulSoup implementation"""
+    text = BeautifulSoup(markup, "html.parser").get_text(separator=" ")
+    if limit is not None and len(text) > limit:
+        text = text[:limit]
+    return text
+
+
+def load_fragments(paths):
+    """Collect (markup, limit) pairs for the titles and descriptions of each feed"""
+    fragments = []
+    for path in paths:
+        feed = feedparser.parse(path)
+        for entry in feed["entries"]:
+            title = entry.get("title")
+            if title and "<" in title and ">" in title:
+                fragments.append((title.strip(), None))
+            if entry.get("description"):
+                fragments.append((entry["description"], MAX_DESCRIPTION_LENGTH))
+    return fragments
+
+
+def time_fn(fn, fragments) -> float:
+    """Best wall-clock time of converting every fragment once"""
+    best = float("inf")
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        for markup, limit in fragments:
+            fn(markup, limit)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    paths = sys.argv[1:] or sorted(glob.glob(os.path.join(FIXTURES_DIR, "*.xml")))
+    fragments = load_fragments(paths)
+    total_chars = sum(len(markup) for markup, _ in fragments)
+    print(f"{len(fragments)} fragments, {total_chars} characters of markup")
+
+    mismatches = [
+        markup
+        for markup, limit in fragments
+        if soup_to_text(markup, limit) != html_to_text(markup, limit)
+    ]
+    print(f"Output mismatches: {len(mismatches)}")
+    for markup in mismatches[:5]:
+        print(f"  {markup[:100]!r}")
+
+    soup_time = time_fn(soup_to_text, fragments)
+    fast_time = time_fn(html_to_text, fragments)
+    per_fragment = 1_000_000 / len(fragments)
+    print(f"BeautifulSoup: {soup_time * 1000:8.2f} ms ({soup_time * per_fragment:.1f} us each)")
+    print(f"html_to_text:  {fast_time * 1000:8.2f} ms ({fast_time * per_fragment:.1f} us each)")
+    print(f"Speedup: {soup_time / fast_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""Benchmark serial vs concurrent article writes against a fake Databases service
+
+Usage: python bench_writes.py [num_articles] [max_workers]
+"""
+
+import sys
+import threading
+import time
+
+from feed_indexing import create_documents
+from index_news_feed import NEWS_ARTICLES_COLLECTION_ID, Article, article_document_id
+
+LATENCIES_MS = [0, 5, 20, 50, 100]
+
+
+class FakeDatabases:
+    """Stand-in for appwrite Databases that sleeps to simulate network latency"""
+
+    def __init__(self, latency_s: float):
+        self.latency_s = latency_s
+        self.documents = {}
+        self.lock = threading.Lock()
+
+    def create_document(self, database_id, collection_id, document_id, data):
+        time.sleep(self.latency_s)
+        with self.lock:
+            if document_id in self.documents:
+                raise Exception("Document with the requested ID already exists")
+            self.documents[document_id] = data
+        return data
+
+
+def make_articles(num_articles: int):
+    """Build a list of (document_id, Article) pairs"""
+    articles = []
+    for i in range(num_articles):
+        article_url = f"https://example.com/articles/{i}"
+        article = Article(
+            title=f"Article {i}",
+            article_url=article_url,
+            news_feed="benchmark",
+            description="Lorem ipsum " * 20,
+        )
+        articles.append((article_document_id(article_url), article))
+    return articles
+
+
+def time_writes(articles, latency_s: float, write_workers: int) -> float:
+    """Time writing all articles to a fresh fake Databases"""
+    databases = FakeDatabases(latency_s)
+    start = time.perf_counter()
+    responses = create_documents(
+        databases,
+        NEWS_ARTICLES_COLLECTION_ID,
+        articles,
+        lambda message: None,
+        write_workers,
+    )
+    elapsed = time.perf_counter() - start
+    assert len(databases.documents) == len(articles)
+    assert len(responses) == len(articles)
+    return elapsed
+
+
+def main():
+    num_articles = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    max_workers = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    worker_counts = [1] + [n for n in (2, 4, 8, 16, 32) if n <= max_workers]
+    articles = make_articles(num_articles)
+
+    print(f"Writing {num_articles} articles")
+    header = "latency ms | " + " | ".join(f"{n:>2} workers" for n in worker_counts)
+    print(header)
+    print("-" * len(header))
+    for latency_ms in LATENCIES_MS:
+        timings = [
+            time_writes(articles, latency_ms / 1000, workers)
+            for workers in worker_counts
+        ]
+        cells = [f"{timings[0]:9.3f}s"]
+        for elapsed in timings[1:]:
+            speedup = timings[0] / elapsed if elapsed else float("inf")
+            cells.append(f"{speedup:9.1f}x")
+        print(f"{latency_ms:>10} | " + " | ".join(cells))
+    print("Serial column is wall-clock time, other columns are speedup over it")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,29 +1,39 @@
 """Serverless Function to fetch articles and podcasts from RSS feeds"""
 
-import datetime
 import http
-import json
-import os
-from hashlib import md5
-from typing import Callable, Dict, Optional
+from hashlib import md5, sha256
+from itertools import takewhile
+from typing import Callable, Dict, List, Optional
 
 import feedparser
-from appwrite.client import Client
+import requests
+from appwrite.query import Query
 from appwrite.services.databases import Databases
-from bs4 import BeautifulSoup
 from pydantic import BaseModel, Field
 
+from article_urls import canonicalize_url
+from feed_indexing import (
+    FEED_CONNECT_TIMEOUT_S,
+    FEED_READ_TIMEOUT_S,
+    FEED_USER_AGENT,
+    FEEDS_DATABASE_ID,
+    LOOKUP_BATCH_SIZE,
+    MAX_DESCRIPTION_LENGTH,
+    FeedSourceRes,
+    HighWaterMark,
+    HighWaterMarkScan,
+    aggregate_responses,
+    create_documents,
+    feed_session,
+    find_existing_document_ids,
+    html_to_text,
+    index_feeds,
+)
 
-PROJECT_ID = "67cccd44002cccfc9ae0"
-FEEDS_DATABASE_ID = "6466af38420c3ca601c1"
 NEWS_FEEDS_COLLECTION_ID = "6797ac1d0029e18b03da"
 NEWS_ARTICLES_COLLECTION_ID = "6797ac2e001706792636"
-
-
-class ServerRequest(BaseModel):
-    """Model for client request to serverless function"""
-
-    feed_id: str = Field(...)
+URL_REDIRECTS_COLLECTION_ID = "url_redirects"
+DEFAULT_UPDATE_INTERVAL_MINUTES = 30
 
 
 class Article(BaseModel):
@@ -38,13 +48,22 @@ class Article(BaseModel):
     description: Optional[str] = Field(default=None)
 
 
+def article_document_id(article_url: str) -> str:
+    """Get the document ID for an article from its canonical URL"""
+    return md5(canonicalize_url(article_url).encode()).hexdigest()
+
+
+def legacy_article_document_id(article_url: str) -> str:
+    """Get the ID articles were stored under before URLs were canonicalized"""
+    return md5(article_url.encode()).hexdigest()
+
+
 def parse_news_article(
     item: Dict,
-    databases: Databases,
     feed_id: str,
     image_url: Optional[str],
     log: Callable,
-) -> http.HTTPStatus:
+) -> Optional[Article]:
     """Parse an article entry in RSS feed into ArticleMetadata"""
     title = item.get("title")
     article_url = item.get("link")
@@ -53,22 +72,17 @@ def parse_news_article(
     description = item.get("description")
 
     if description is not None:
-        soup = BeautifulSoup(description, "html.parser")
-        description = soup.get_text(separator=" ")
-
-    if len(description) > 4096:
-        description = description[:4096]
+        description = html_to_text(description, MAX_DESCRIPTION_LENGTH)
     log(f"Parsed description {description}")
 
     if title is None or article_url is None:
-        return http.HTTPStatus.INTERNAL_SERVER_ERROR
+        return None
 
     title = title.strip()
-    if "<" and ">" in title:
-        soup = BeautifulSoup(title, "html.parser")
-        title = soup.get_text(separator=" ")
+    if "<" in title and ">" in title:
+        title = html_to_text(title)
 
-    article = Article(
+    return Article(
         title=title,
         article_url=article_url,
         news_feed=feed_id,
@@ -77,101 +91,220 @@ def parse_news_article(
         author=author,
         description=description,
     )
-    document_id = md5(article_url.encode()).hexdigest()
-    try:
-        databases.create_document(
-            FEEDS_DATABASE_ID,
-            NEWS_ARTICLES_COLLECTION_ID,
-            document_id,
-            article.model_dump(exclude_none=True),
-        )
-    except Exception as e:
-        log(f"Failed to create document {document_id} {e}")
-        return http.HTTPStatus.CONFLICT
-    return http.HTTPStatus.OK
+
+
+def find_known_redirects(
+    databases: Databases, urls: List[str], log: Callable
+) -> Dict[str, str]:
+    """Look up which canonical URLs are known to redirect, mapped to their targets
+
+    Redirects are recorded by summarize when an article's text is extracted
+    from a different article page, keyed by the source URL's article
+    document ID. They are aliases used to find already indexed articles,
+    never document IDs, so unrelated articles can't share a document.
+    """
+    urls_by_id = {article_document_id(url): url for url in urls}
+    redirects = {}
+    document_ids = list(urls_by_id)
+    for start in range(0, len(document_ids), LOOKUP_BATCH_SIZE):
+        batch = document_ids[start : start + LOOKUP_BATCH_SIZE]
+        try:
+            res = databases.list_documents(
+                FEEDS_DATABASE_ID,
+                URL_REDIRECTS_COLLECTION_ID,
+                queries=[
+                    Query.equal("$id", batch),
+                    Query.select(["$id", "target_url"]),
+                    Query.limit(len(batch)),
+                ],
+            )
+        except Exception as e:
+            log(f"Failed to look up known redirects {e}")
+            continue
+        for document in res["documents"]:
+            redirects[urls_by_id[document["$id"]]] = document["target_url"]
+    return redirects
 
 
 def fetch_article_source(
-    rss_url: str, databases: Databases, feed_id: str, log: Callable
-) -> http.HTTPStatus:
-    """Download RSS feed and parse into ArticleSource"""
+    rss_url: str,
+    databases: Databases,
+    feed_id: str,
+    log: Callable,
+    etag: Optional[str] = None,
+    last_modified: Optional[str] = None,
+    high_water_mark: Optional[HighWaterMark] = None,
+    write_workers: int = 1,
+    content_hash: Optional[str] = None,
+) -> FeedSourceRes:
+    """Download RSS feed and parse into ArticleSource
+
+    The stored ETag and Last-Modified values are sent back as conditional
+    headers, so an unchanged feed costs a 304 instead of a full download.
+    The download is bounded by connect and read timeouts, so a dead or
+    stalled publisher fails fast instead of holding the execution. Servers
+    that ignore conditional requests are caught by comparing a hash of the
+    body with the one stored on the last update, which skips parsing.
+    Entries at or behind the high-water mark are never parsed or looked up,
+    unless the feed lists its entries out of pub date order.
+    """
     log(f"Fetching RSS feed {rss_url}")
+    headers = {"User-Agent": FEED_USER_AGENT}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    try:
+        response = feed_session.get(
+            rss_url,
+            headers=headers,
+            timeout=(FEED_CONNECT_TIMEOUT_S, FEED_READ_TIMEOUT_S),
+        )
+    except requests.RequestException as e:
+        log(f"Failed to download RSS feed {rss_url} {e}")
+        return FeedSourceRes(
+            status=http.HTTPStatus.INTERNAL_SERVER_ERROR, fetch_failed=True
+        )
+    fetch_ms = round(response.elapsed.total_seconds() * 1000)
+    if response.status_code == http.HTTPStatus.NOT_MODIFIED:
+        log(f"RSS feed {rss_url} not modified since last update")
+        return FeedSourceRes(
+            status=http.HTTPStatus.CONFLICT,
+            etag=etag,
+            last_modified=last_modified,
+            fetch_ms=fetch_ms,
+        )
+    if not response.ok:
+        log(f"Failed to download RSS feed {rss_url} {response.status_code}")
+        return FeedSourceRes(
+            status=http.HTTPStatus.INTERNAL_SERVER_ERROR,
+            fetch_failed=True,
+            fetch_ms=fetch_ms,
+        )
+
+    digest = sha256(response.content).hexdigest()
+    if digest == content_hash:
+        log(f"RSS feed {rss_url} unchanged since last update")
+        return FeedSourceRes(
+            status=http.HTTPStatus.CONFLICT,
+            etag=response.headers.get("ETag"),
+            last_modified=response.headers.get("Last-Modified"),
+            fetch_ms=fetch_ms,
+            content_hash=digest,
+        )
+
+    # feedparser reads the charset from content-type and resolves relative
+    # links against content-location
+    response_headers = {key.lower(): value for key, value in response.headers.items()}
+    response_headers["content-location"] = response.url
     try:
-        feed = feedparser.parse(rss_url)
+        feed = feedparser.parse(response.content, response_headers=response_headers)
     except Exception:
         log(f"Failed to parse RSS feed {rss_url}")
-        return http.HTTPStatus.INTERNAL_SERVER_ERROR
+        return FeedSourceRes(
+            status=http.HTTPStatus.INTERNAL_SERVER_ERROR,
+            fetch_failed=True,
+            fetch_ms=fetch_ms,
+        )
     if not feed["entries"]:
         log(f"No entries found in RSS feed {rss_url}")
-        return http.HTTPStatus.INTERNAL_SERVER_ERROR
+        return FeedSourceRes(
+            status=http.HTTPStatus.INTERNAL_SERVER_ERROR,
+            fetch_failed=True,
+            fetch_ms=fetch_ms,
+        )
 
     log(f"Found {len(feed['entries'])} entries in RSS feed {rss_url}")
     image_url = None
     if image := feed["feed"].get("image"):
         image_url = image.get("url")
 
-    article_responses = []
-    for entry in feed["entries"]:
-        res = parse_news_article(entry, databases, feed_id, image_url, log)
-        article_responses.append(res)
-
-    if all(res == http.HTTPStatus.INTERNAL_SERVER_ERROR for res in article_responses):
-        return http.HTTPStatus.INTERNAL_SERVER_ERROR
-    elif any(res == http.HTTPStatus.INTERNAL_SERVER_ERROR for res in article_responses):
-        return http.HTTPStatus.PARTIAL_CONTENT
-    elif all(res == http.HTTPStatus.CONFLICT for res in article_responses):
-        return http.HTTPStatus.CONFLICT
-    return http.HTTPStatus.OK
-
-
-def main(context):
-    """Main entry point for the news feed parsing serverless function"""
+    scan = HighWaterMarkScan(high_water_mark or HighWaterMark())
+    scan.check_feed_order(feed["entries"])
+    if not scan.in_order:
+        log("Entries are out of order, scanning the full feed")
+    entries = list(
+        takewhile(lambda entry: not scan.reached_mark(entry), feed["entries"])
+    )
+    if scan.reached:
+        log(f"Reached high-water mark after {len(entries)} new entries")
+    if not entries:
+        return FeedSourceRes(
+            status=http.HTTPStatus.CONFLICT,
+            etag=response.headers.get("ETag"),
+            last_modified=response.headers.get("Last-Modified"),
+            high_water_mark=scan.next_mark(),
+            publish_gap_minutes=scan.publish_gap_minutes(),
+            fetch_ms=fetch_ms,
+            content_hash=digest,
+        )
 
-    def log(message):
-        context.log(f"{datetime.datetime.now().strftime('%H:%M:%S')}: {message}")
+    article_responses = []
+    parsed_articles = []
+    for entry in entries:
+        article = parse_news_article(entry, feed_id, image_url, log)
+        if article is None:
+            article_responses.append(http.HTTPStatus.INTERNAL_SERVER_ERROR)
+            continue
+        parsed_articles.append(article)
 
-    log("Starting parsing request")
-    req_body = json.loads(context.req.body)
-    log(f"Got request body {req_body}")
-    req_data = ServerRequest(**req_body)
+    # Variants of one link share a document, keyed by the canonical URL
+    canonical_urls = [
+        canonicalize_url(article.article_url) for article in parsed_articles
+    ]
+    redirects = find_known_redirects(databases, canonical_urls, log)
+    articles = {}
+    alias_ids = {}
+    for article, canonical_url in zip(parsed_articles, canonical_urls):
+        document_id = article_document_id(canonical_url)
+        articles[document_id] = article
+        # Articles indexed before canonical URLs keep their raw URL's ID, and
+        # an article may already be indexed under the URL it redirects to
+        aliases = {legacy_article_document_id(article.article_url)}
+        if canonical_url in redirects:
+            aliases.add(article_document_id(redirects[canonical_url]))
+        aliases.discard(document_id)
+        alias_ids[document_id] = aliases
 
-    client = Client()
-    client.set_key(os.getenv("APPWRITE_API_KEY"))
-    client.set_endpoint("https://appwrite.liammasters.space/v1")
-    client.set_project(PROJECT_ID)
+    existing_ids = find_existing_document_ids(
+        databases,
+        NEWS_ARTICLES_COLLECTION_ID,
+        list(articles) + list(set().union(*alias_ids.values())),
+        log,
+    )
+    log(f"Skipping {len(existing_ids)} articles that are already indexed")
+    new_articles = []
+    for document_id, article in articles.items():
+        if document_id in existing_ids or alias_ids[document_id] & existing_ids:
+            article_responses.append(http.HTTPStatus.CONFLICT)
+        else:
+            new_articles.append((document_id, article))
+    created_responses = create_documents(
+        databases, NEWS_ARTICLES_COLLECTION_ID, new_articles, log, write_workers
+    )
+    if http.HTTPStatus.INTERNAL_SERVER_ERROR in created_responses:
+        scan.writes_failed = True
+    article_responses += created_responses
 
-    databases = Databases(client)
+    status = aggregate_responses(article_responses)
+    return FeedSourceRes(
+        status=status,
+        etag=response.headers.get("ETag"),
+        last_modified=response.headers.get("Last-Modified"),
+        high_water_mark=scan.next_mark(),
+        new_items=created_responses.count(http.HTTPStatus.OK),
+        publish_gap_minutes=scan.publish_gap_minutes(),
+        fetch_ms=fetch_ms,
+        content_hash=digest,
+    )
 
-    log("Fetching article feed...")
-    try:
-        feed_res = databases.get_document(
-            FEEDS_DATABASE_ID, NEWS_FEEDS_COLLECTION_ID, req_data.feed_id
-        )
-    except Exception as e:
-        log(f"Failed to fetch feed document {req_data.feed_id} {e}")
-        return context.res.json(
-            {"message": str(e)}, statusCode=http.HTTPStatus.INTERNAL_SERVER_ERROR
-        )
-    try:
-        res = fetch_article_source(
-            feed_res["rss_url"], databases, req_data.feed_id, log
-        )
-    except Exception as e:  # pylint: disable=broad-except
-        log(f"Exception occurred fetching data {e}")
-        return context.res.json(
-            {"message": str(e)},
-            statusCode=http.HTTPStatus.INTERNAL_SERVER_ERROR,
-        )
 
-    databases.update_document(
-        FEEDS_DATABASE_ID,
+def main(context):
+    """Main entry point for the news feed parsing serverless function"""
+    return index_feeds(
+        context,
         NEWS_FEEDS_COLLECTION_ID,
-        req_data.feed_id,
-        {
-            "last_update": datetime.datetime.now(tz=datetime.timezone.utc).strftime(
-                "%Y-%m-%dT%H:%M:%S.%f%z"
-            )
-        },
+        fetch_article_source,
+        DEFAULT_UPDATE_INTERVAL_MINUTES,
+        "article",
     )
-    log("Finished fetching data")
-    return context.res.json({}, statusCode=res)
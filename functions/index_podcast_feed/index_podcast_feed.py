@@ -1,27 +1,42 @@
 import datetime
 import http
-import json
 import os
-from hashlib import md5
-from typing import Callable, Dict, Optional
+import xml.etree.ElementTree as ET
+from hashlib import md5, sha256
+from itertools import islice
+from typing import IO, Any, Callable, Dict, Iterator, List, Optional, Tuple
 
-import feedparser
-from appwrite.client import Client
+import requests
 from appwrite.services.databases import Databases
-from bs4 import BeautifulSoup
 from pydantic import BaseModel, Field
 
+from feed_indexing import (
+    FEED_CONNECT_TIMEOUT_S,
+    FEED_READ_TIMEOUT_S,
+    FEED_USER_AGENT,
+    LOOKUP_BATCH_SIZE,
+    MAX_DESCRIPTION_LENGTH,
+    FeedSourceRes,
+    HighWaterMark,
+    HighWaterMarkScan,
+    aggregate_responses,
+    create_documents,
+    entry_published,
+    feed_session,
+    find_existing_document_ids,
+    html_to_text,
+    index_feeds,
+)
 
-PROJECT_ID = "67cccd44002cccfc9ae0"
-FEEDS_DATABASE_ID = "6466af38420c3ca601c1"
 PODCAST_FEEDS_COLLECTION_ID = "6797ac11003778ff768a"
 PODCAST_EPISODES_COLLECTION_ID = "6797ac2700062e762fdd"
-
-
-class ServerRequest(BaseModel):
-    """Model for client request to serverless function"""
-
-    feed_id: str = Field(...)
+FIRST_BATCH_SIZE = 10
+MAX_EPISODE_AGE_DAYS = int(os.getenv("INDEX_MAX_EPISODE_AGE_DAYS", "0"))
+ITUNES_NS = "{http://www.itunes.com/dtds/podcast-1.0.dtd}"
+ITUNES_IMAGE = f"{ITUNES_NS}image"
+ITUNES_SUMMARY = f"{ITUNES_NS}summary"
+ITUNES_DURATION = f"{ITUNES_NS}duration"
+DEFAULT_UPDATE_INTERVAL_MINUTES = 240
 
 
 class Episode(BaseModel):
@@ -40,7 +55,7 @@ def format_length(duration: str) -> int:
     """Get length of podcast in seconds from string"""
     try:
         return int(duration)
-    except ValueError:
+    except (TypeError, ValueError):
         return 0
 
 
@@ -52,22 +67,23 @@ def format_itunes_duration(duration: str) -> int:
         else:
             hours, minutes, seconds = duration.split(":")
             return int(hours) * 3600 + int(minutes) * 60 + int(seconds)
-    except ValueError:
+    except (AttributeError, ValueError):
         return 0
 
 
 def parse_podcast_episode(
     item: Dict,
-    databases: Databases,
     feed_id: str,
     image_url: Optional[str],
     log: Callable,
-) -> http.HTTPStatus:
+) -> Optional[Episode]:
     """Parse a podcast episode in RSS feed into PodcastEpisode"""
     title = item.get("title")
     description = item.get("description")
     pub_date = item.get("published")
     duration = item.get("itunes_duration")
+    audio_url = None
+    backup_duration = None
     for link in item.get("links"):
         if "audio" in link.get("type"):
             audio_url = link.get("href")
@@ -76,17 +92,16 @@ def parse_podcast_episode(
     duration_s = format_itunes_duration(duration) or format_length(backup_duration)
 
     if title is None or audio_url is None:
-        return http.HTTPStatus.INTERNAL_SERVER_ERROR
+        log(f"Skipping episode without title or audio {item.get('id')}")
+        return None
 
     title = title.strip()
-    if "<" and ">" in title:
-        soup = BeautifulSoup(title, "html.parser")
-        title = soup.get_text(separator=" ")
+    if "<" in title and ">" in title:
+        title = html_to_text(title)
     if description:
-        soup = BeautifulSoup(description, "html.parser")
-        description = soup.get_text(separator=" ")
+        description = html_to_text(description, MAX_DESCRIPTION_LENGTH)
 
-    episode = Episode(
+    return Episode(
         title=title,
         audio_url=audio_url,
         podcast_feed=feed_id,
@@ -95,106 +110,354 @@ def parse_podcast_episode(
         pub_date=pub_date,
         duration_s=duration_s,
     )
-    document_id = md5(f"{title}{audio_url}".encode()).hexdigest()
-    try:
-        databases.create_document(
-            FEEDS_DATABASE_ID,
-            PODCAST_EPISODES_COLLECTION_ID,
-            document_id,
-            episode.model_dump(exclude_none=True),
-        )
-    except Exception as e:
-        log(f"Failed to create document {document_id} {e}")
-        return http.HTTPStatus.CONFLICT
-    return http.HTTPStatus.OK
 
 
-def fetch_podcast_source(
-    rss_url: str, databases: Databases, feed_id: str, log: Callable
-) -> http.HTTPStatus:
-    """Download podcast RSS feed and parse into PodcastSource"""
-    try:
-        feed = feedparser.parse(rss_url)
-    except Exception:
-        log(f"Failed to parse RSS feed {rss_url}")
-        return http.HTTPStatus.INTERNAL_SERVER_ERROR
-    if not feed["entries"]:
-        log(f"No entries found in RSS feed {rss_url}")
-        return http.HTTPStatus.INTERNAL_SERVER_ERROR
+def episode_document_id(episode: Episode) -> str:
+    """Get the document ID for an episode from its title and audio URL"""
+    return md5(f"{episode.title}{episode.audio_url}".encode()).hexdigest()
 
-    log(f"Found {len(feed['entries'])} entries in RSS feed {rss_url}")
-    image_url = None
-    if image := feed["feed"].get("image"):
-        image_url = image.get("href")
 
-    episode_responses = []
-    last_3_responses = []
-    for entry in feed["entries"]:
-        res = parse_podcast_episode(entry, databases, feed_id, image_url, log)
-        last_3_responses.append(res)
-        episode_responses.append(res)
-        if len(last_3_responses) > 3:
-            last_3_responses.pop(0)
-        if all(res == http.HTTPStatus.CONFLICT for res in last_3_responses):
-            log(f"Encountered existing episodes, exiting early")
-            break
+class NotRSSFeed(Exception):
+    """Raised when a document can't be read by the streaming RSS parser"""
 
-    if all(res == http.HTTPStatus.INTERNAL_SERVER_ERROR for res in episode_responses):
-        return http.HTTPStatus.INTERNAL_SERVER_ERROR
-    elif any(res == http.HTTPStatus.INTERNAL_SERVER_ERROR for res in episode_responses):
-        return http.HTTPStatus.PARTIAL_CONTENT
-    elif all(res == http.HTTPStatus.CONFLICT for res in episode_responses):
-        return http.HTTPStatus.CONFLICT
-    return http.HTTPStatus.OK
 
+class RSSItemStream:
+    """Incrementally parse an RSS 2.0 document, one feedparser-style entry per item
 
-def main(context):
-    """Main function for the Cloud Function"""
+    Items are discarded from the tree as soon as they have been yielded, so
+    memory use stays flat no matter how many episodes the feed contains.
+    The bytes read before the first item are kept, so a document that turns
+    out not to be RSS can be handed to another parser without downloading
+    it again.
+    """
+
+    def __init__(self, source: IO[bytes]):
+        self.source = source
+        self.image_url: Optional[str] = None
+        self.error: Optional[Exception] = None
+        self.head: Optional[List[bytes]] = []
+
+    def read(self, size: int = -1) -> bytes:
+        """Read from the source for the XML parser, keeping the document head"""
+        data = self.source.read(size)
+        if self.head is not None:
+            self.head.append(data)
+        return data
+
+    def read_document(self) -> bytes:
+        """Read the whole document after NotRSSFeed, including what was parsed"""
+        return b"".join(self.head or []) + self.source.read()
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        channel = None
+        item_depth = 0
+        items_read = 0
+        events = ET.iterparse(self, events=("start", "end"))
+        try:
+            for event, elem in events:
+                if event == "start":
+                    if channel is None and elem.tag not in ("rss", "channel"):
+                        raise NotRSSFeed(f"Unexpected element {elem.tag}")
+                    if elem.tag == "channel":
+                        channel = elem
+                    elif elem.tag == "item":
+                        item_depth += 1
+                    continue
+
+                if elem.tag == "item":
+                    item_depth -= 1
+                    items_read += 1
+                    # It's RSS, so the head is no longer needed
+                    self.head = None
+                    yield self.parse_item(elem)
+                    channel.remove(elem)
+                elif item_depth == 0 and self.image_url is None:
+                    if elem.tag == ITUNES_IMAGE:
+                        self.image_url = elem.get("href")
+                    elif elem.tag == "image":
+                        self.image_url = (elem.findtext("url") or "").strip() or None
+        except ET.ParseError as e:
+            if not items_read:
+                raise NotRSSFeed(str(e)) from e
+            self.error = e
+
+    @staticmethod
+    def parse_item(item: ET.Element) -> Dict[str, Any]:
+        """Convert an <item> element into the fields feedparser would give it"""
+
+        def text(tag: str) -> Optional[str]:
+            value = item.findtext(tag)
+            return value.strip() if value is not None else None
+
+        return {
+            "id": text("guid"),
+            "title": text("title"),
+            "description": text("description") or text(ITUNES_SUMMARY),
+            "published": text("pubDate"),
+            "itunes_duration": text(ITUNES_DURATION),
+            "links": [
+                {
+                    "type": enclosure.get("type", ""),
+                    "href": enclosure.get("url"),
+                    "length": enclosure.get("length"),
+                }
+                for enclosure in item.findall("enclosure")
+            ],
+        }
+
+
+def published_before(entry: Dict, cutoff: datetime.datetime) -> bool:
+    """Check whether an entry's pub date is older than the cutoff"""
+    published = entry_published(entry)
+    return published is not None and published < cutoff
+
+
+def index_podcast_entries(
+    entries: Iterator[Dict],
+    get_image_url: Callable[[], Optional[str]],
+    scan: HighWaterMarkScan,
+    databases: Databases,
+    feed_id: str,
+    log: Callable,
+    write_workers: int = 1,
+) -> Tuple[List[http.HTTPStatus], bool]:
+    """Parse and store podcast entries, newest first, until reaching the feed's
+    high-water mark
+
+    Entries are pulled from the iterator a batch at a time so a long back
+    catalogue is never read past the mark or the max episode age. Feeds
+    that publish out of order are scanned in full, skipping episodes past
+    the max age. Returns the responses and whether any episode was past
+    the max age.
+    """
+    cutoff = None
+    if MAX_EPISODE_AGE_DAYS:
+        cutoff = datetime.datetime.now(
+            tz=datetime.timezone.utc
+        ) - datetime.timedelta(days=MAX_EPISODE_AGE_DAYS)
 
-    def log(message):
-        context.log(f"{datetime.datetime.now().strftime('%H:%M:%S')}: {message}")
+    episode_responses = []
+    # Most polls only find a few new episodes at the top of the feed
+    batch_size = FIRST_BATCH_SIZE
+    reached_cutoff = False
+    stopped_at_cutoff = False
+    while True:
+        episodes = []
+        read_any = False
+        for entry in islice(entries, batch_size):
+            read_any = True
+            if scan.reached_mark(entry):
+                break
+            # The entry after the first one past the max age shows whether the
+            # feed is newest first, or whether newer episodes can still follow
+            if reached_cutoff and scan.trusts_order:
+                stopped_at_cutoff = True
+                break
+            if cutoff and published_before(entry, cutoff):
+                reached_cutoff = True
+                continue
+            episode = parse_podcast_episode(entry, feed_id, get_image_url(), log)
+            document_id = episode_document_id(episode) if episode else None
+            episodes.append((document_id, episode))
+        batch_size = LOOKUP_BATCH_SIZE
+
+        if episodes:
+            existing_ids = find_existing_document_ids(
+                databases,
+                PODCAST_EPISODES_COLLECTION_ID,
+                [document_id for document_id, _ in episodes if document_id],
+                log,
+            )
+            batch_responses = []
+            new_episodes = []
+            for document_id, episode in episodes:
+                if episode is None:
+                    res = http.HTTPStatus.INTERNAL_SERVER_ERROR
+                elif document_id in existing_ids:
+                    res = http.HTTPStatus.CONFLICT
+                else:
+                    res = None
+                    new_episodes.append((document_id, episode))
+                batch_responses.append(res)
 
-    log("Starting parsing request")
-    req_body = json.loads(context.req.body)
-    log(f"Got request body {req_body}")
-    req_data = ServerRequest(**req_body)
+            created_responses = create_documents(
+                databases,
+                PODCAST_EPISODES_COLLECTION_ID,
+                new_episodes,
+                log,
+                write_workers,
+            )
+            if http.HTTPStatus.INTERNAL_SERVER_ERROR in created_responses:
+                scan.writes_failed = True
+            created_responses = iter(created_responses)
+            episode_responses += [
+                res if res is not None else next(created_responses)
+                for res in batch_responses
+            ]
 
-    client = Client()
-    client.set_key(os.getenv("APPWRITE_API_KEY"))
-    client.set_endpoint("https://appwrite.liammasters.space/v1")
-    client.set_project(PROJECT_ID)
+        if scan.reached:
+            log(f"Reached high-water mark after {len(episode_responses)} new entries")
+            break
+        if stopped_at_cutoff:
+            log(f"Reached episodes older than {MAX_EPISODE_AGE_DAYS} days")
+            break
+        if not read_any:
+            break
+    if not scan.in_order:
+        log("Entries are out of order, scanned the full feed")
+    return episode_responses, reached_cutoff
 
-    databases = Databases(client)
 
-    log("Fetching podcast feed...")
+def fetch_podcast_source(
+    rss_url: str,
+    databases: Databases,
+    feed_id: str,
+    log: Callable,
+    etag: Optional[str] = None,
+    last_modified: Optional[str] = None,
+    high_water_mark: Optional[HighWaterMark] = None,
+    write_workers: int = 1,
+    content_hash: Optional[str] = None,
+) -> FeedSourceRes:
+    """Download podcast RSS feed and parse into PodcastSource
+
+    The stored ETag and Last-Modified values are sent back as conditional
+    headers, so an unchanged feed costs a 304 instead of a full download.
+    The response is parsed as it streams in and the connection is closed
+    as soon as indexing stops, so very large feeds are never read in full.
+    Entries at or behind the high-water mark are never parsed or looked up.
+    Feeds that can't be streamed are read in full from the same response,
+    and skipped without parsing when the body hashes the same as on the
+    last update.
+    """
+    headers = {"User-Agent": FEED_USER_AGENT}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
     try:
-        feed_res = databases.get_document(
-            FEEDS_DATABASE_ID, PODCAST_FEEDS_COLLECTION_ID, req_data.feed_id
+        response = feed_session.get(
+            rss_url,
+            headers=headers,
+            stream=True,
+            timeout=(FEED_CONNECT_TIMEOUT_S, FEED_READ_TIMEOUT_S),
         )
-    except Exception as e:
-        log(f"Failed to get feed document {req_data.feed_id} {e}")
-        return context.res.json(
-            {"message": str(e)}, statusCode=http.HTTPStatus.INTERNAL_SERVER_ERROR
+    except requests.RequestException as e:
+        log(f"Failed to download RSS feed {rss_url} {e}")
+        return FeedSourceRes(
+            status=http.HTTPStatus.INTERNAL_SERVER_ERROR, fetch_failed=True
         )
-    try:
-        res = fetch_podcast_source(
-            feed_res["rss_url"], databases, req_data.feed_id, log
-        )
-    except Exception as e:  # pylint: disable=broad-except
-        log("Exception occurred fetching data {e}")
-        return context.res.json(
-            {"message": str(e)}, statusCode=http.HTTPStatus.INTERNAL_SERVER_ERROR
+    # Time until the feed server answered, the body is read while indexing
+    fetch_ms = round(response.elapsed.total_seconds() * 1000)
+
+    with response:
+        if response.status_code == http.HTTPStatus.NOT_MODIFIED:
+            log(f"RSS feed {rss_url} not modified since last update")
+            return FeedSourceRes(
+                status=http.HTTPStatus.CONFLICT,
+                etag=etag,
+                last_modified=last_modified,
+                fetch_ms=fetch_ms,
+            )
+        if not response.ok:
+            log(f"Failed to download RSS feed {rss_url} {response.status_code}")
+            return FeedSourceRes(
+                status=http.HTTPStatus.INTERNAL_SERVER_ERROR,
+                fetch_failed=True,
+                fetch_ms=fetch_ms,
+            )
+
+        response.raw.decode_content = True
+        stream = RSSItemStream(response.raw)
+        scan = HighWaterMarkScan(high_water_mark or HighWaterMark())
+        digest = None
+        try:
+            episode_responses, reached_cutoff = index_podcast_entries(
+                iter(stream),
+                lambda: stream.image_url,
+                scan,
+                databases,
+                feed_id,
+                log,
+                write_workers,
+            )
+        except NotRSSFeed as e:
+            log(f"Could not stream RSS feed {rss_url} ({e}), using feedparser")
+            # Only Atom and malformed feeds need feedparser, so skip loading it
+            # on every cold start
+            import feedparser
+
+            try:
+                content = stream.read_document()
+            except Exception as e:  # pylint: disable=broad-except
+                log(f"Failed to download RSS feed {rss_url} {e}")
+                return FeedSourceRes(
+                    status=http.HTTPStatus.INTERNAL_SERVER_ERROR,
+                    fetch_failed=True,
+                    fetch_ms=fetch_ms,
+                )
+            response_headers = {
+                key.lower(): value for key, value in response.headers.items()
+            }
+            response_headers["content-location"] = response.url
+            digest = sha256(content).hexdigest()
+            if digest == content_hash:
+                log(f"RSS feed {rss_url} unchanged since last update")
+                return FeedSourceRes(
+                    status=http.HTTPStatus.CONFLICT,
+                    etag=response.headers.get("ETag"),
+                    last_modified=response.headers.get("Last-Modified"),
+                    fetch_ms=fetch_ms,
+                    content_hash=digest,
+                )
+            feed = feedparser.parse(content, response_headers=response_headers)
+            image_url = None
+            if image := feed["feed"].get("image"):
+                image_url = image.get("href")
+            episode_responses, reached_cutoff = index_podcast_entries(
+                iter(feed["entries"]),
+                lambda: image_url,
+                scan,
+                databases,
+                feed_id,
+                log,
+                write_workers,
+            )
+        if stream.error:
+            log(f"Stopped reading malformed RSS feed {rss_url} {stream.error}")
+
+    # A quiet podcast whose newest episode is past the max age has nothing new,
+    # like one whose newest episode is at the high-water mark
+    if not episode_responses and not scan.reached and not reached_cutoff:
+        log(f"No entries found in RSS feed {rss_url}")
+        return FeedSourceRes(
+            status=http.HTTPStatus.INTERNAL_SERVER_ERROR,
+            fetch_failed=True,
+            fetch_ms=fetch_ms,
         )
+    log(f"Processed {len(episode_responses)} entries in RSS feed {rss_url}")
+
+    status = aggregate_responses(episode_responses or [http.HTTPStatus.CONFLICT])
+    if stream.error and status in (http.HTTPStatus.OK, http.HTTPStatus.CONFLICT):
+        status = http.HTTPStatus.PARTIAL_CONTENT
+    return FeedSourceRes(
+        status=status,
+        etag=response.headers.get("ETag"),
+        last_modified=response.headers.get("Last-Modified"),
+        high_water_mark=None if stream.error else scan.next_mark(),
+        new_items=episode_responses.count(http.HTTPStatus.OK),
+        publish_gap_minutes=scan.publish_gap_minutes(),
+        fetch_ms=fetch_ms,
+        content_hash=digest,
+    )
+
 
-    databases.update_document(
-        FEEDS_DATABASE_ID,
+def main(context):
+    """Main function for the Cloud Function"""
+    return index_feeds(
+        context,
         PODCAST_FEEDS_COLLECTION_ID,
-        req_data.feed_id,
-        {
-            "last_update": datetime.datetime.now(tz=datetime.timezone.utc).strftime(
-                "%Y-%m-%dT%H:%M:%S.%f%z"
-            )
-        },
+        fetch_podcast_source,
+        DEFAULT_UPDATE_INTERVAL_MINUTES,
+        "podcast",
     )
-    log("Finished fetching data")
-    return context.res.json({}, statusCode=res)
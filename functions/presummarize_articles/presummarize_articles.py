@@ -0,0 +1,331 @@
+"""Serverless function to summarize popular articles before anyone asks for them"""
+
+import datetime
+import json
+import os
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import md5
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from appwrite.exception import AppwriteException
+from appwrite.input_file import InputFile
+from appwrite.query import Query
+from appwrite.services.databases import Databases
+from appwrite.services.storage import Storage
+from pydantic import BaseModel, Field
+
+from appwrite_client import connection_stats, get_client, iter_documents
+from article_urls import canonicalize_url
+from summaries import (
+    SUMMARY_MODE,
+    acquire_summary_lease,
+    extract_article_text,
+    release_summary_lease,
+    request_summary,
+)
+
+FEEDS_DATABASE_ID = "6466af38420c3ca601c1"
+SUBSCRIPTIONS_COLLECTION_ID = "6797b43c001f4e9c95a0"
+NEWS_ARTICLES_COLLECTION_ID = "6797ac2e001706792636"
+SUMMARY_TOKEN_USAGE_COLLECTION_ID = "summary_token_usage"
+URL_REDIRECTS_COLLECTION_ID = "url_redirects"
+SUMMARY_BUCKET_ID = "664bcddf002e5c7eba87"
+PRESUMMARIZE_WORKERS = int(os.getenv("PRESUMMARIZE_WORKERS", "4"))
+PRESUMMARIZE_MAX_ARTICLES = int(os.getenv("PRESUMMARIZE_MAX_ARTICLES", "100"))
+PRESUMMARIZE_MAX_FEEDS = int(os.getenv("PRESUMMARIZE_MAX_FEEDS", "50"))
+PRESUMMARIZE_ARTICLES_PER_FEED = int(os.getenv("PRESUMMARIZE_ARTICLES_PER_FEED", "5"))
+PRESUMMARIZE_RECENT_HOURS = int(os.getenv("PRESUMMARIZE_RECENT_HOURS", "24"))
+SUMMARY_DAILY_TOKEN_BUDGET = int(os.getenv("SUMMARY_DAILY_TOKEN_BUDGET", "2000000"))
+# Reserved per summary until this run has real usage to average
+DEFAULT_SUMMARY_TOKENS = 4000
+
+
+class ServerRequest(BaseModel):
+    """Model for cron request (optional, in case called with parameters)"""
+
+    max_articles: int = Field(default=PRESUMMARIZE_MAX_ARTICLES, ge=0)
+
+
+class TokenBudget:
+    """Gemini tokens left for the day, shared by concurrent summaries
+
+    Usage is stored per UTC day in the summary_token_usage collection. Each
+    summary reserves its expected cost before calling Gemini, so concurrent
+    calls can't overshoot the budget together, then records what it used.
+    """
+
+    def __init__(self, databases: Databases, limit: int, log: Callable):
+        self.databases = databases
+        self.limit = limit
+        self.log = log
+        self.day = datetime.datetime.now(tz=datetime.timezone.utc).strftime(
+            "%Y-%m-%d"
+        )
+        self.used = 0
+        self.reserved = 0
+        self.summaries = 0
+        self.spent = 0
+        self.exists = False
+        self.lock = threading.Lock()
+        try:
+            usage = databases.get_document(
+                FEEDS_DATABASE_ID, SUMMARY_TOKEN_USAGE_COLLECTION_ID, self.day
+            )
+            self.used = usage["tokens_used"]
+            self.exists = True
+        except AppwriteException as e:
+            if e.code != 404:
+                raise
+
+    def estimate(self) -> int:
+        """Expected tokens for one summary, averaged over this run so far"""
+        if not self.summaries:
+            return DEFAULT_SUMMARY_TOKENS
+        return max(1, round(self.spent / self.summaries))
+
+    def reserve(self) -> int:
+        """Reserve tokens for one summary, or return 0 if the budget is spent"""
+        with self.lock:
+            estimate = self.estimate()
+            if self.used + self.reserved + estimate > self.limit:
+                return 0
+            self.reserved += estimate
+            return estimate
+
+    def record(self, reserved: int, tokens: int):
+        """Swap a reservation for the tokens actually used and store the total"""
+        with self.lock:
+            self.reserved -= reserved
+            if not tokens:
+                return
+            self.used += tokens
+            self.spent += tokens
+            self.summaries += 1
+            usage = {"tokens_used": self.used}
+            try:
+                if self.exists:
+                    self.databases.update_document(
+                        FEEDS_DATABASE_ID,
+                        SUMMARY_TOKEN_USAGE_COLLECTION_ID,
+                        self.day,
+                        usage,
+                    )
+                else:
+                    self.databases.create_document(
+                        FEEDS_DATABASE_ID,
+                        SUMMARY_TOKEN_USAGE_COLLECTION_ID,
+                        self.day,
+                        usage,
+                    )
+                    self.exists = True
+            except AppwriteException as e:
+                self.log(f"Failed to store token usage {e}")
+
+
+def count_feed_subscribers(databases: Databases) -> Counter:
+    """Count how many subscriptions include each news feed"""
+    subscribers = Counter()
+    for subscription in iter_documents(
+        databases,
+        FEEDS_DATABASE_ID,
+        SUBSCRIPTIONS_COLLECTION_ID,
+        [Query.select(["$id", "news_feed_ids"])],
+    ):
+        subscribers.update(set(subscription.get("news_feed_ids") or []))
+    return subscribers
+
+
+def rank_articles(
+    databases: Databases, subscribers: Counter, max_articles: int, log: Callable
+) -> List[Dict[str, Any]]:
+    """Get recent unsummarized articles, from the most subscribed feeds first
+
+    Only the newest few articles of each of the top feeds are considered,
+    and ties between feeds with the same subscriber count go to the newest
+    article.
+    """
+    cutoff = datetime.datetime.now(tz=datetime.timezone.utc) - datetime.timedelta(
+        hours=PRESUMMARIZE_RECENT_HOURS
+    )
+    candidates = []
+    for feed_id, count in subscribers.most_common(PRESUMMARIZE_MAX_FEEDS):
+        try:
+            res = databases.list_documents(
+                FEEDS_DATABASE_ID,
+                NEWS_ARTICLES_COLLECTION_ID,
+                queries=[
+                    Query.equal("news_feed", feed_id),
+                    Query.greater_than_equal("pub_date", cutoff.isoformat()),
+                    Query.is_null("summary_id"),
+                    Query.select(["$id", "article_url", "pub_date"]),
+                    Query.order_desc("pub_date"),
+                    Query.limit(PRESUMMARIZE_ARTICLES_PER_FEED),
+                ],
+            )
+        except AppwriteException as e:
+            log(f"Failed to list articles for feed {feed_id} {e}")
+            continue
+        candidates += [(count, article) for article in res["documents"]]
+    candidates.sort(
+        key=lambda item: (item[0], item[1].get("pub_date") or ""), reverse=True
+    )
+    return [article for _, article in candidates[:max_articles]]
+
+
+def summary_exists(storage: Storage, url_hash: str) -> bool:
+    """Check whether an article's summary is already in storage"""
+    try:
+        storage.get_file(SUMMARY_BUCKET_ID, url_hash)
+        return True
+    except AppwriteException:
+        return False
+
+
+def find_summary_hash(
+    databases: Databases, storage: Storage, article_url: str
+) -> Optional[str]:
+    """Get the hash an article's existing summary is stored under, or None
+
+    summarize stores summaries under the canonical URL's hash. A summary
+    may also be stored under the URL the article is known to redirect to,
+    or under the raw URL from before URLs were canonicalized.
+    """
+    url_hash = md5(canonicalize_url(article_url).encode()).hexdigest()
+    if summary_exists(storage, url_hash):
+        return url_hash
+    try:
+        redirect = databases.get_document(
+            FEEDS_DATABASE_ID, URL_REDIRECTS_COLLECTION_ID, url_hash
+        )
+    except AppwriteException:
+        pass
+    else:
+        target_hash = md5(redirect["target_url"].encode()).hexdigest()
+        if summary_exists(storage, target_hash):
+            return target_hash
+    legacy_hash = md5(article_url.encode()).hexdigest()
+    if legacy_hash != url_hash and summary_exists(storage, legacy_hash):
+        return legacy_hash
+    return None
+
+
+def generate_summary(article_url: str, log: Callable) -> Tuple[Optional[str], int]:
+    """Summarize an article with Gemini, returning the text and tokens used
+
+    Like summarize_article, the summary is made from the article's extracted
+    text, falling back to search grounding when too little text is found.
+    """
+    article_text = None
+    if SUMMARY_MODE == "extracted":
+        try:
+            article_text, _ = extract_article_text(article_url, log)
+        except Exception as e:
+            log(f"Failed to extract text of {article_url}: {e}")
+    summary_text, usage = request_summary(article_url, article_text)
+    tokens = (usage.total_token_count or 0) if usage else 0
+    return summary_text, tokens
+
+
+def presummarize_article(
+    article: Dict[str, Any],
+    databases: Databases,
+    storage: Storage,
+    budget: TokenBudget,
+    log: Callable,
+) -> str:
+    """Summarize one article into storage and link it, returning the outcome"""
+    url_hash = find_summary_hash(databases, storage, article["article_url"])
+    if url_hash is None:
+        url_hash = md5(canonicalize_url(article["article_url"]).encode()).hexdigest()
+        reserved = budget.reserve()
+        if not reserved:
+            return "over_budget"
+        if not acquire_summary_lease(databases, url_hash, log):
+            budget.record(reserved, 0)
+            return "in_progress"
+        try:
+            tokens = 0
+            try:
+                summary_text, tokens = generate_summary(article["article_url"], log)
+            except Exception as e:
+                log(f"Failed to summarize article {article['$id']}: {e}")
+                return "failed"
+            finally:
+                budget.record(reserved, tokens)
+            if not summary_text:
+                log(f"No summary text generated for article {article['$id']}")
+                return "failed"
+            try:
+                storage.create_file(
+                    SUMMARY_BUCKET_ID,
+                    url_hash,
+                    InputFile.from_bytes(
+                        json.dumps({"summary": summary_text}).encode(),
+                        filename=url_hash,
+                        mime_type="application/json",
+                    ),
+                )
+            except AppwriteException as e:
+                log(f"Failed to upload summary for article {article['$id']}: {e}")
+                return "failed"
+        finally:
+            release_summary_lease(databases, url_hash, log)
+        outcome = "summarized"
+    else:
+        outcome = "existing"
+
+    try:
+        databases.update_document(
+            FEEDS_DATABASE_ID,
+            NEWS_ARTICLES_COLLECTION_ID,
+            article["$id"],
+            {"summary_id": url_hash},
+        )
+    except AppwriteException as e:
+        log(f"Failed to update article {article['$id']} with summary: {e}")
+        return "failed"
+    return outcome
+
+
+def main(context):
+    """Summarize recent articles from the most subscribed feeds"""
+    context.log("Starting article pre-summarization")
+    req_body = json.loads(context.req.body or "{}")
+    req_data = ServerRequest(**req_body)
+
+    appwrite_client = get_client()
+    context.log(f"Appwrite connections in this process {connection_stats()}")
+
+    databases = Databases(appwrite_client)
+    storage = Storage(appwrite_client)
+
+    budget = TokenBudget(databases, SUMMARY_DAILY_TOKEN_BUDGET, context.log)
+    context.log(f"Used {budget.used} of {budget.limit} summary tokens today")
+    if budget.used >= budget.limit:
+        return context.res.json({"message": "Daily token budget spent"})
+
+    subscribers = count_feed_subscribers(databases)
+    articles = rank_articles(
+        databases, subscribers, req_data.max_articles, context.log
+    )
+    context.log(
+        f"Found {len(articles)} articles to summarize from "
+        f"{len(subscribers)} subscribed feeds"
+    )
+    if not articles:
+        return context.res.json({"message": "No articles to summarize"})
+
+    with ThreadPoolExecutor(max_workers=PRESUMMARIZE_WORKERS) as executor:
+        outcomes = Counter(
+            executor.map(
+                lambda article: presummarize_article(
+                    article, databases, storage, budget, context.log
+                ),
+                articles,
+            )
+        )
+    context.log(f"Pre-summarization results {dict(outcomes)}")
+    context.log(f"Used {budget.used} of {budget.limit} summary tokens today")
+    return context.res.json({"results": dict(outcomes), "tokens_used": budget.used})
@@ -1,9 +1,7 @@
 """Serverless function to record a user's listen time to a podcast episode"""
 
 import json
-import os
 
-from appwrite.client import Client
 from appwrite.id import ID
 from appwrite.permission import Permission
 from appwrite.query import Query
@@ -11,6 +9,8 @@ from appwrite.role import Role
 from appwrite.services.databases import Databases
 from pydantic import BaseModel, Field
 
+from appwrite_client import connection_stats, get_client
+
 
 class ServerRequest(BaseModel):
     """Model for client request to serverless function"""
@@ -22,10 +22,8 @@ class ServerRequest(BaseModel):
 
 
 def main(context):
-    client = Client()
-    client.set_key(os.getenv("APPWRITE_API_KEY"))
-    client.set_endpoint("https://appwrite.liammasters.space/v1")
-    client.set_project("67cccd44002cccfc9ae0")
+    client = get_client()
+    context.log(f"Appwrite connections in this process {connection_stats()}")
 
     databases = Databases(client)
 
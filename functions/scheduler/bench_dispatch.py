@@ -0,0 +1,84 @@
+"""Benchmark execution dispatch against a fake Functions service
+
+Compares the old serial loop with dispatch_executions at several pool sizes,
+with and without the default token bucket rate limit.
+
+Usage: python bench_dispatch.py [num_feeds] [latency_ms]
+"""
+
+import sys
+import threading
+import time
+
+from scheduler import (
+    DISPATCH_BURST,
+    DISPATCH_RATE_PER_S,
+    INDEX_NEWS_FEED_FUNCTION_ID,
+    TokenBucket,
+    dispatch_executions,
+)
+
+WORKER_COUNTS = [1, 4, 8, 16, 32]
+
+
+class FakeFunctions:
+    """Stand-in for appwrite Functions that sleeps to simulate network latency"""
+
+    def __init__(self, latency_s: float):
+        self.latency_s = latency_s
+        self.executions = []
+        self.lock = threading.Lock()
+
+    def create_execution(self, function_id, body=None, xasync=False, **kwargs):
+        time.sleep(self.latency_s)
+        with self.lock:
+            self.executions.append((function_id, body))
+            return {"$id": f"execution{len(self.executions)}"}
+
+
+def time_serial(jobs, latency_s: float) -> float:
+    """Time the previous one-call-at-a-time loop"""
+    functions = FakeFunctions(latency_s)
+    start = time.perf_counter()
+    for function_id, feed_ids in jobs:
+        functions.create_execution(function_id, body=feed_ids, xasync=True)
+    return time.perf_counter() - start
+
+
+def time_dispatch(jobs, latency_s: float, workers: int, rate: float) -> float:
+    """Time dispatch_executions with a fresh token bucket"""
+    functions = FakeFunctions(latency_s)
+    bucket = TokenBucket(rate, DISPATCH_BURST)
+    start = time.perf_counter()
+    execution_ids = dispatch_executions(
+        functions, jobs, bucket, lambda message: None, workers
+    )
+    elapsed = time.perf_counter() - start
+    assert len(functions.executions) == len(jobs)
+    assert None not in execution_ids
+    return elapsed
+
+
+def main():
+    num_feeds = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    latency_ms = float(sys.argv[2]) if len(sys.argv) > 2 else 50
+    latency_s = latency_ms / 1000
+    jobs = [(INDEX_NEWS_FEED_FUNCTION_ID, [f"feed{i}"]) for i in range(num_feeds)]
+
+    print(f"Dispatching {num_feeds} executions at {latency_ms:g} ms per call")
+    serial = time_serial(jobs, latency_s)
+    print(f"serial loop      {serial:7.2f}s {num_feeds / serial:8.1f} executions/s")
+    for label, rate in (
+        ("unlimited", 1e9),
+        (f"{DISPATCH_RATE_PER_S:g}/s limit", DISPATCH_RATE_PER_S),
+    ):
+        for workers in WORKER_COUNTS:
+            elapsed = time_dispatch(jobs, latency_s, workers, rate)
+            print(
+                f"{workers:>2} workers, {label:<12} {elapsed:7.2f}s "
+                f"{num_feeds / elapsed:8.1f} executions/s"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -4,162 +4,439 @@ import http
 import json
 import os
 import datetime
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
-from appwrite.client import Client
 from appwrite.services.databases import Databases
 from appwrite.services.functions import Functions
 from appwrite.query import Query
 
-PROJECT_ID = "67cccd44002cccfc9ae0"
+from appwrite_client import (
+    PAGE_SIZE,
+    connection_stats,
+    get_client,
+    iter_documents,
+    wait_for_executions,
+)
+from feed_indexing import MAX_FEEDS_PER_HOST, feed_host
+
 FEED_DATABASE_ID = "6466af38420c3ca601c1"
 NEWS_FEEDS_COLLECTION_ID = "6797ac1d0029e18b03da"
 PODCAST_FEEDS_COLLECTION_ID = "6797ac11003778ff768a"
 INDEX_NEWS_FEED_FUNCTION_ID = "679fc996043c9a90e2df"
 INDEX_PODCAST_FEED_FUNCTION_ID = "679fe0e256c67950d62e"
+MIN_UPDATE_INTERVAL_MINUTES = int(os.getenv("MIN_UPDATE_INTERVAL_MINUTES", "30"))
+MAX_UPDATE_INTERVAL_MINUTES = int(os.getenv("MAX_UPDATE_INTERVAL_MINUTES", "1440"))
+DISPATCH_WORKERS = int(os.getenv("DISPATCH_WORKERS", "8"))
+DISPATCH_RATE_PER_S = float(os.getenv("DISPATCH_RATE_PER_S", "50"))
+DISPATCH_BURST = int(os.getenv("DISPATCH_BURST", "20"))
+SHARD_SIZE = int(os.getenv("SHARD_SIZE", "10"))
+SHARD_COST_BUDGET_MS = int(os.getenv("SHARD_COST_BUDGET_MS", "60000"))
+DEFAULT_FEED_COST_MS = 5000
+RESULT_WAIT_S = float(os.getenv("RESULT_WAIT_S", "600"))
+DUE_FEED_ATTRIBUTES = [
+    "$id",
+    "feed_title",
+    "rss_url",
+    "update_interval_minutes",
+    "last_new_items",
+    "publish_gap_minutes",
+    "last_index_ms",
+]
 
 
-def wait_for_execution(functions, function_id, execution_id):
-    while True:
-        execution = functions.get_execution(function_id, execution_id)
-        if execution["status"] in ("completed", "failed"):
-            return execution
+def due_feed_queries(now: datetime.datetime) -> List[str]:
+    """Queries for feeds whose next update is due, including feeds that have
+    never been indexed and so have no next_update_at yet
 
+    Feeds whose circuit breaker is open after repeated fetch failures are
+    skipped until its cooldown has passed.
+    """
+    return [
+        Query.or_queries(
+            [
+                Query.less_than_equal("next_update_at", now.isoformat()),
+                Query.is_null("next_update_at"),
+            ]
+        ),
+        Query.or_queries(
+            [
+                Query.less_than_equal("breaker_open_until", now.isoformat()),
+                Query.is_null("breaker_open_until"),
+            ]
+        ),
+        Query.select(DUE_FEED_ATTRIBUTES),
+    ]
 
-def main(context):
-    client = Client()
-    client.set_key(os.getenv("APPWRITE_API_KEY"))
-    client.set_endpoint("https://appwrite.liammasters.space/v1")
-    client.set_project(PROJECT_ID)
 
-    databases = Databases(client)
-    functions = Functions(client)
+def adapt_update_interval(
+    interval: int, last_new_items: Optional[int], publish_gap_minutes: Optional[int]
+) -> int:
+    """Pick a feed's next update interval from what its last index run found
 
-    news_rss_feeds = []
-    num_results = 100
-    page_size = 100
-    offset = 0
-    while num_results >= page_size:
-        res = databases.list_documents(
-            FEED_DATABASE_ID,
-            NEWS_FEEDS_COLLECTION_ID,
-            queries=[Query.limit(page_size), Query.offset(offset)],
-        )
-        if not res:
-            context.error("No news feeds found")
-            break
-        else:
-            context.log(f"Found {len(res['documents'])} news feeds")
-            news_rss_feeds += res["documents"]
-            num_results = len(res["documents"])
-            offset += page_size
-            
-    num_results = 100
-    offset = 0
-    podcast_rss_feeds = []
-    while num_results >= page_size:
-        res = databases.list_documents(
+    Quiet feeds back off exponentially. Feeds that had several new items
+    waiting are polled at least twice as often, and no less often than they
+    publish. The result is kept within the configured bounds.
+    """
+    if last_new_items is None:
+        return interval
+    if last_new_items == 0:
+        interval *= 2
+    elif last_new_items > 1:
+        interval //= 2
+        if publish_gap_minutes:
+            interval = min(interval, publish_gap_minutes)
+    elif publish_gap_minutes and publish_gap_minutes < interval:
+        interval = (interval + publish_gap_minutes) // 2
+    return max(MIN_UPDATE_INTERVAL_MINUTES, min(MAX_UPDATE_INTERVAL_MINUTES, interval))
+
+
+def update_feed_interval(
+    databases: Databases, collection_id: str, feed: Dict[str, Any], log: Callable
+):
+    """Store an adapted update interval on a due feed, if it changed
+
+    last_new_items is cleared along with it so the same run's result is
+    never applied twice, for example if the index execution fails.
+    """
+    interval = feed.get("update_interval_minutes") or MIN_UPDATE_INTERVAL_MINUTES
+    new_interval = adapt_update_interval(
+        interval, feed.get("last_new_items"), feed.get("publish_gap_minutes")
+    )
+    if new_interval == interval:
+        return
+    try:
+        databases.update_document(
             FEED_DATABASE_ID,
-            PODCAST_FEEDS_COLLECTION_ID,
-            queries=[Query.limit(page_size), Query.offset(offset)],
+            collection_id,
+            feed["$id"],
+            {"update_interval_minutes": new_interval, "last_new_items": None},
         )
-        if not res:
-            context.error("No podcast feeds found")
-            break
+    except Exception as e:
+        log(f"Failed to update interval of feed {feed['$id']} {e}")
+        return
+    log(
+        f"Changed update interval of feed {feed['$id']} "
+        f"from {interval} to {new_interval} minutes"
+    )
+
+
+class TokenBucket:
+    """Thread-safe token bucket allowing rate calls per second, in bursts of
+    up to capacity calls"""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, waiting until one is available"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_s = (1 - self.tokens) / self.rate
+            time.sleep(wait_s)
+
+
+def shard_feeds(
+    feeds: List[Dict[str, Any]],
+    shard_size: int = SHARD_SIZE,
+    cost_budget_ms: int = SHARD_COST_BUDGET_MS,
+    max_per_host: int = MAX_FEEDS_PER_HOST,
+) -> List[Tuple[List[str], Dict[str, int]]]:
+    """Pack feeds into shards of feed IDs by their last index cost
+
+    A host's due feeds are split into chunks of at most shard_size, and its
+    max_per_host concurrent fetches are shared out between them. Each shard
+    comes with the limit of every host it holds part of, which the indexer
+    applies in place of its own, so a publisher with many feeds never sees
+    more fetches at once than with a single execution. A host has at most
+    max_per_host chunks, feeds past those stay due for the next run.
+    Chunks are placed most expensive first into the first shard with room,
+    where a shard holds at most shard_size feeds and cost_budget_ms of
+    index time. A chunk that doesn't fit gets a shard to itself, so one
+    slow or crowded publisher can't hold up many others.
+    """
+
+    def cost(feed: Dict[str, Any]) -> int:
+        return feed.get("last_index_ms") or DEFAULT_FEED_COST_MS
+
+    hosts: Dict[str, List[Dict[str, Any]]] = {}
+    for feed in feeds:
+        hosts.setdefault(feed_host(feed), []).append(feed)
+
+    chunks: List[Tuple[List[str], Dict[str, int], int]] = []
+    for host, group in hosts.items():
+        host_chunks = [
+            group[start : start + shard_size]
+            for start in range(0, len(group), shard_size)
+        ][:max_per_host]
+        for i, chunk in enumerate(host_chunks):
+            limits = {}
+            if len(host_chunks) > 1:
+                # The first chunks take any remainder
+                limits[host] = max_per_host // len(host_chunks) + (
+                    i < max_per_host % len(host_chunks)
+                )
+            feed_ids = [feed["$id"] for feed in chunk]
+            chunks.append((feed_ids, limits, sum(cost(feed) for feed in chunk)))
+
+    shards: List[Tuple[List[str], Dict[str, int]]] = []
+    shard_costs: List[int] = []
+    for feed_ids, limits, chunk_cost in sorted(
+        chunks, key=lambda chunk: chunk[2], reverse=True
+    ):
+        for i, (shard, shard_limits) in enumerate(shards):
+            if (
+                len(shard) + len(feed_ids) <= shard_size
+                and shard_costs[i] + chunk_cost <= cost_budget_ms
+            ):
+                shard += feed_ids
+                shard_limits.update(limits)
+                shard_costs[i] += chunk_cost
+                break
         else:
-            context.log(f"Found {len(res['documents'])} podcast feeds")
-            podcast_rss_feeds += res["documents"]
-            num_results = len(res["documents"])
-            offset += page_size
+            shards.append((feed_ids, limits))
+            shard_costs.append(chunk_cost)
+    return shards
 
-    news_feed_id_to_execution_id = {}
-    for feed in news_rss_feeds:
-        "2025-01-30T20:06:38.061+00:00"
-        last_update = datetime.datetime.strptime(
-            feed["last_update"], "%Y-%m-%dT%H:%M:%S.%f%z"
-        )
-        update_interval = feed["update_interval_minutes"]
-        if (
-            datetime.datetime.now(tz=datetime.timezone.utc) - last_update
-        ).total_seconds() / 60 > update_interval:
-            context.log(f"Updating news feed {feed['$id']} {feed['feed_title']}")
+
+def dispatch_executions(
+    functions: Functions,
+    jobs: List[Tuple[str, List[str], Dict[str, int]]],
+    bucket: TokenBucket,
+    log: Callable,
+    workers: int = DISPATCH_WORKERS,
+) -> List[Optional[str]]:
+    """Create async executions for (function ID, shard feed IDs, host limits)
+    jobs concurrently
+
+    Calls are spread over up to workers threads and paced by the token
+    bucket. Execution IDs are returned in the same order as the jobs, with
+    None for jobs that failed to dispatch.
+    """
+
+    def dispatch(job: Tuple[str, List[str], Dict[str, int]]) -> Optional[str]:
+        function_id, feed_ids, host_limits = job
+        bucket.acquire()
+        try:
             execution = functions.create_execution(
-                INDEX_NEWS_FEED_FUNCTION_ID,
-                body=json.dumps({"feed_id": feed["$id"]}),
+                function_id,
+                body=json.dumps({"feed_ids": feed_ids, "host_limits": host_limits}),
                 xasync=True,
             )
-            news_feed_id_to_execution_id[feed["$id"]] = execution["$id"]
-        else:
-            context.log(
-                f"Skipping news feed {feed['$id']} {feed['feed_title']} as it was updated recently"
-            )
+        except Exception as e:
+            log(f"Failed to dispatch feeds {feed_ids} {e}")
+            return None
+        return execution["$id"]
 
-    podcast_feed_id_to_execution_id = {}
-    for feed in podcast_rss_feeds:
-        last_update = datetime.datetime.strptime(
-            feed["last_update"], "%Y-%m-%dT%H:%M:%S.%f%z"
+    if not jobs:
+        return []
+    with ThreadPoolExecutor(max_workers=min(workers, len(jobs))) as executor:
+        return list(executor.map(dispatch, jobs))
+
+
+def updated_feed_statuses(
+    databases: Databases,
+    collection_id: str,
+    feed_ids: List[str],
+    since: datetime.datetime,
+) -> Dict[str, int]:
+    """Get last_status of the feeds that were indexed since a time
+
+    Async executions don't keep their response body, so each feed's result
+    is read back from its own document instead. Indexers set last_update at
+    the end of every run, so feeds missing from the result haven't finished.
+    """
+    statuses = {}
+    for start in range(0, len(feed_ids), PAGE_SIZE):
+        batch = feed_ids[start : start + PAGE_SIZE]
+        res = databases.list_documents(
+            FEED_DATABASE_ID,
+            collection_id,
+            queries=[
+                Query.equal("$id", batch),
+                Query.greater_than_equal("last_update", since.isoformat()),
+                Query.select(["$id", "last_status"]),
+                Query.limit(len(batch)),
+            ],
         )
-        update_interval = feed["update_interval_minutes"]
-        if (
-            datetime.datetime.now(tz=datetime.timezone.utc) - last_update
-        ).total_seconds() / 60 > update_interval:
-            context.log(f"Updating podcast feed {feed['$id']} {feed['feed_title']}")
-            execution = functions.create_execution(
-                INDEX_PODCAST_FEED_FUNCTION_ID,
-                body=json.dumps({"feed_id": feed["$id"]}),
-                xasync=True,
-            )
-            podcast_feed_id_to_execution_id[feed["$id"]] = execution["$id"]
-        else:
-            context.log(
-                f"Skipping podcast feed {feed['$id']} {feed['feed_title']} as it was updated recently"
+        statuses.update(
+            {
+                feed["$id"]: feed["last_status"]
+                for feed in res["documents"]
+                if feed.get("last_status") is not None
+            }
+        )
+    return statuses
+
+
+def feed_status(
+    execution: Optional[Dict[str, Any]], last_status: Optional[int]
+) -> Optional[int]:
+    """Get the result code of a dispatched feed
+
+    A feed indexed since dispatch has the status its indexer stored. A feed
+    that wasn't indexed is None while its execution is still running, and
+    failed if the execution finished without getting to it.
+    """
+    if last_status is not None:
+        return last_status
+    if execution is None:
+        return None
+    return int(http.HTTPStatus.INTERNAL_SERVER_ERROR)
+
+
+def main(context):
+    client = get_client()
+    context.log(f"Appwrite connections in this process {connection_stats()}")
+
+    databases = Databases(client)
+    functions = Functions(client)
+
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+
+    due_feeds = []
+    for collection_id in (NEWS_FEEDS_COLLECTION_ID, PODCAST_FEEDS_COLLECTION_ID):
+        due_feeds += [
+            (collection_id, feed)
+            for feed in iter_documents(
+                databases, FEED_DATABASE_ID, collection_id, due_feed_queries(now)
             )
+        ]
+    context.log(f"Found {len(due_feeds)} feeds due for update")
 
-    return context.res.json(
-        {"message": "Scheduled feed updates"}, statusCode=http.HTTPStatus.ACCEPTED
-    )
+    with ThreadPoolExecutor(max_workers=DISPATCH_WORKERS) as executor:
+        executor.map(
+            lambda item: update_feed_interval(databases, *item, context.log),
+            due_feeds,
+        )
 
-    news_feed_id_to_execution_result = {}
-    for feed_id, execution_id in news_feed_id_to_execution_id.items():
-        execution = wait_for_execution(
-            functions, INDEX_NEWS_FEED_FUNCTION_ID, execution_id
+    jobs = []
+    for collection_id, function_id in (
+        (NEWS_FEEDS_COLLECTION_ID, INDEX_NEWS_FEED_FUNCTION_ID),
+        (PODCAST_FEEDS_COLLECTION_ID, INDEX_PODCAST_FEED_FUNCTION_ID),
+    ):
+        feeds = [
+            feed
+            for feed_collection, feed in due_feeds
+            if feed_collection == collection_id
+        ]
+        for feed in feeds:
+            context.log(f"Updating feed {feed['$id']} {feed['feed_title']}")
+        jobs += [
+            (function_id, feed_ids, host_limits)
+            for feed_ids, host_limits in shard_feeds(feeds)
+        ]
+    packed = sum(len(feed_ids) for _, feed_ids, _ in jobs)
+    context.log(f"Packed {packed} feeds into {len(jobs)} executions")
+    if packed < len(due_feeds):
+        context.log(
+            f"Left {len(due_feeds) - packed} feeds over the per-host limit "
+            "for the next run"
         )
-        news_feed_id_to_execution_result[feed_id] = execution["responseStatusCode"]
-    context.log(f"News feed results: {news_feed_id_to_execution_result}")
 
-    podcast_feed_id_to_execution_result = {}
-    for feed_id, execution_id in podcast_feed_id_to_execution_id.items():
-        execution = wait_for_execution(
-            functions, INDEX_PODCAST_FEED_FUNCTION_ID, execution_id
+    bucket = TokenBucket(DISPATCH_RATE_PER_S, DISPATCH_BURST)
+    execution_ids = dispatch_executions(functions, jobs, bucket, context.log)
+    news_feed_id_to_execution_id = {}
+    podcast_feed_id_to_execution_id = {}
+    for (function_id, feed_ids, _), execution_id in zip(jobs, execution_ids):
+        if execution_id is None:
+            continue
+        for feed_id in feed_ids:
+            if function_id == INDEX_NEWS_FEED_FUNCTION_ID:
+                news_feed_id_to_execution_id[feed_id] = execution_id
+            else:
+                podcast_feed_id_to_execution_id[feed_id] = execution_id
+    context.log(
+        f"Dispatched {len(news_feed_id_to_execution_id)} news feeds and "
+        f"{len(podcast_feed_id_to_execution_id)} podcast feeds"
+    )
+    if not jobs:
+        return context.res.json(
+            {"message": "No feeds due for update"}, statusCode=http.HTTPStatus.OK
         )
-        podcast_feed_id_to_execution_result[feed_id] = execution["responseStatusCode"]
-    context.log(f"Podcast feed results: {podcast_feed_id_to_execution_result}")
-
-    if all(
-        status == http.HTTPStatus.OK
-        for status in news_feed_id_to_execution_result.values()
-    ) and all(
-        status == http.HTTPStatus.OK
-        for status in podcast_feed_id_to_execution_result.values()
+
+    dispatched = [
+        (function_id, execution_id)
+        for (function_id, _, _), execution_id in zip(jobs, execution_ids)
+        if execution_id is not None
+    ]
+    executions = wait_for_executions(
+        functions, dispatched, RESULT_WAIT_S, context.log, DISPATCH_WORKERS
+    )
+    updated_statuses = {}
+    for collection_id, feed_id_to_execution_id in (
+        (NEWS_FEEDS_COLLECTION_ID, news_feed_id_to_execution_id),
+        (PODCAST_FEEDS_COLLECTION_ID, podcast_feed_id_to_execution_id),
     ):
+        try:
+            updated_statuses.update(
+                updated_feed_statuses(
+                    databases, collection_id, list(feed_id_to_execution_id), now
+                )
+            )
+        except Exception as e:
+            context.log(f"Failed to read back feed results {e}")
+    feed_statuses = {}
+    for (function_id, feed_ids, _), execution_id in zip(jobs, execution_ids):
+        for feed_id in feed_ids:
+            if execution_id is None:
+                feed_statuses[feed_id] = int(http.HTTPStatus.INTERNAL_SERVER_ERROR)
+            else:
+                feed_statuses[feed_id] = feed_status(
+                    executions.get(execution_id), updated_statuses.get(feed_id)
+                )
+    news_feed_results = {
+        feed_id: feed_statuses[feed_id] for feed_id in news_feed_id_to_execution_id
+    }
+    podcast_feed_results = {
+        feed_id: feed_statuses[feed_id] for feed_id in podcast_feed_id_to_execution_id
+    }
+    context.log(f"News feed results: {news_feed_results}")
+    context.log(f"Podcast feed results: {podcast_feed_results}")
+
+    pending = [feed_id for feed_id, status in feed_statuses.items() if status is None]
+    if pending:
+        context.log(f"Feeds still updating at the deadline: {pending}")
+    succeeded = [
+        feed_id
+        for feed_id, status in feed_statuses.items()
+        if status
+        in (http.HTTPStatus.OK, http.HTTPStatus.CONFLICT, http.HTTPStatus.NOT_MODIFIED)
+    ]
+    partial = [
+        feed_id
+        for feed_id, status in feed_statuses.items()
+        if status == http.HTTPStatus.PARTIAL_CONTENT
+    ]
+    if len(succeeded) == len(feed_statuses):
         context.log("All feeds updated successfully")
         return context.res.json(
-            {"message": "Successfully updated all feeds"}, statusCode=http.HTTPStatus.OK
+            {"message": "Successfully updated all feeds", "feeds": feed_statuses},
+            statusCode=http.HTTPStatus.OK,
         )
-    elif any(
-        status == http.HTTPStatus.OK
-        for status in news_feed_id_to_execution_result.values()
-    ) or any(
-        status == http.HTTPStatus.OK
-        for status in podcast_feed_id_to_execution_result.values()
-    ):
+    elif succeeded or partial or pending:
         context.log("Some feeds updated successfully")
         return context.res.json(
-            {"message": "Successfully updated some feeds"},
+            {"message": "Successfully updated some feeds", "feeds": feed_statuses},
             statusCode=http.HTTPStatus.PARTIAL_CONTENT,
         )
     else:
         context.error("Failed to update any feeds")
         return context.res.json(
-            {"message": "Failed to update any feeds"},
+            {"message": "Failed to update any feeds", "feeds": feed_statuses},
             statusCode=http.HTTPStatus.INTERNAL_SERVER_ERROR,
         )
@@ -0,0 +1,122 @@
+"""Measure article prefetch throughput, one page at a time against batched
+
+Saved article pages are served from local HTTP servers, one per simulated
+publisher, each adding a fixed delay per request to stand in for the
+round trip to a real site. Sequential fetches match opening articles one
+by one, batched fetches go through fetch_article_contents with its
+per-host limit. Neither uses the article cache, so only downloading and
+extraction are measured.
+
+Usage: python bench_prefetch.py [--hosts N] [--latency S] [--runs N] [page.html ...]
+"""
+
+import argparse
+import functools
+import glob
+import http
+import http.server
+import os
+import statistics
+import threading
+import time
+
+from get_article import (
+    PREFETCH_PER_HOST,
+    PREFETCH_WORKERS,
+    fetch_article_content,
+    fetch_article_contents,
+)
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+class PublisherHandler(http.server.SimpleHTTPRequestHandler):
+    """Serves article pages after a delay, tracking concurrent requests"""
+
+    latency_s = 0.0
+    active = 0
+    peak = 0
+    lock = threading.Lock()
+
+    def do_GET(self):
+        cls = type(self)
+        with cls.lock:
+            cls.active += 1
+            cls.peak = max(cls.peak, cls.active)
+        try:
+            time.sleep(cls.latency_s)
+            super().do_GET()
+        finally:
+            with cls.lock:
+                cls.active -= 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(directory: str, latency_s: float) -> type:
+    """Serve a directory as one publisher, returning its handler class"""
+    handler_class = type(
+        "Publisher", (PublisherHandler,), {"lock": threading.Lock(), "peak": 0}
+    )
+    handler_class.latency_s = latency_s
+    handler = functools.partial(handler_class, directory=directory)
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    handler_class.base_url = f"http://127.0.0.1:{server.server_port}"
+    return handler_class
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("pages", nargs="*")
+    parser.add_argument("--hosts", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--copies", type=int, default=3)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+    pages = args.pages or sorted(glob.glob(os.path.join(FIXTURES_DIR, "*.html")))
+    directory = os.path.dirname(os.path.abspath(pages[0]))
+    if any(os.path.dirname(os.path.abspath(page)) != directory for page in pages):
+        parser.error("pages must be in one directory")
+
+    publishers = [serve(directory, args.latency) for _ in range(args.hosts)]
+    # Copies differ by query so each is a separate article to the cache key
+    urls = [
+        f"{publisher.base_url}/{os.path.basename(page)}?copy={copy}"
+        for publisher in publishers
+        for page in pages
+        for copy in range(args.copies)
+    ]
+
+    def sequential():
+        return [fetch_article_content(url).status for url in urls]
+
+    def batched():
+        return list(fetch_article_contents(urls, lambda message: None).values())
+
+    results = {}
+    for name, run in [("sequential", sequential), ("batched", batched)]:
+        samples = []
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            statuses = run()
+            samples.append(time.perf_counter() - start)
+        failures = sum(1 for status in statuses if status != http.HTTPStatus.OK)
+        results[name] = (statistics.median(samples), failures)
+
+    print(
+        f"{len(urls)} articles on {args.hosts} hosts, {args.latency:.2f}s latency, "
+        f"{PREFETCH_WORKERS} workers, {PREFETCH_PER_HOST} per host"
+    )
+    print(f"{'mode':<11} {'median s':>9} {'articles/s':>11} {'failures':>9}")
+    for name, (seconds, failures) in results.items():
+        print(
+            f"{name:<11} {seconds:>9.2f} {len(urls) / seconds:>11.1f} "
+            f"{failures:>5}/{len(urls)}"
+        )
+    print(f"Peak requests to one host {max(p.peak for p in publishers)}")
+
+
+if __name__ == "__main__":
+    main()
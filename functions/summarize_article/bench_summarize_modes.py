@@ -0,0 +1,124 @@
+"""Compare summarizing from extracted article text with URL + search grounding
+
+Each article page is served from a local HTTP server, so the extracted mode
+downloads and parses the saved page. The url mode sends the page's canonical
+URL and leaves Gemini to find the article, as summarize did before. The
+fixtures are sample pages, save real articles from a browser and pass their
+paths to compare on production content.
+
+Both modes call Gemini and need GOOGLE_GEMINI_API_KEY. Without it only text
+extraction is measured, with input tokens estimated from the text length.
+
+Usage: python bench_summarize_modes.py [--runs N] [page.html ...]
+"""
+
+import argparse
+import functools
+import glob
+import http.server
+import os
+import re
+import statistics
+import threading
+import time
+
+from summaries import (
+    CHARS_PER_TOKEN,
+    SUMMARY_INSTRUCTIONS,
+    build_summary_request,
+    extract_article_text,
+)
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+CANONICAL_RE = re.compile(r'<link rel="canonical" href="([^"]+)"')
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    """Serves the article pages without logging every request"""
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(directory: str) -> str:
+    """Serve a directory on a local port and return its base URL"""
+    handler = functools.partial(QuietHandler, directory=directory)
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+
+def summarize_page(client, mode: str, local_url: str, canonical_url: str) -> dict:
+    """Summarize one page in one mode, returning its latency, tokens and outcome"""
+    start = time.perf_counter()
+    article_text = None
+    if mode == "extracted":
+        article_text, _ = extract_article_text(
+            local_url, print, use_cache=False
+        )
+        if article_text is None:
+            return {"seconds": time.perf_counter() - start, "failed": True}
+    if client is None:
+        tokens = len(f"{SUMMARY_INSTRUCTIONS}\n\n{article_text}") // CHARS_PER_TOKEN
+        return {"seconds": time.perf_counter() - start, "tokens": tokens}
+    try:
+        response = client.models.generate_content(
+            **build_summary_request(canonical_url, article_text)
+        )
+    except Exception as e:  # pylint: disable=broad-except
+        print(f"  {mode} {canonical_url} failed: {e}")
+        return {"seconds": time.perf_counter() - start, "failed": True}
+    usage = response.usage_metadata
+    return {
+        "seconds": time.perf_counter() - start,
+        "tokens": usage.prompt_token_count if usage else None,
+        "failed": not response.text,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("pages", nargs="*")
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+    pages = args.pages or sorted(glob.glob(os.path.join(FIXTURES_DIR, "*.html")))
+
+    client = None
+    modes = ["extracted"]
+    if os.getenv("GOOGLE_GEMINI_API_KEY"):
+        from google import genai
+
+        client = genai.Client(api_key=os.getenv("GOOGLE_GEMINI_API_KEY"))
+        modes.append("url")
+    else:
+        print("GOOGLE_GEMINI_API_KEY is not set, measuring text extraction only")
+
+    directories = {os.path.dirname(os.path.abspath(page)) for page in pages}
+    base_urls = {directory: serve(directory) for directory in directories}
+    results = {mode: [] for mode in modes}
+    for page in pages:
+        path = os.path.abspath(page)
+        local_url = f"{base_urls[os.path.dirname(path)]}/{os.path.basename(path)}"
+        with open(path, encoding="utf-8") as f:
+            match = CANONICAL_RE.search(f.read())
+        canonical_url = match.group(1) if match else local_url
+        for mode in modes:
+            for _ in range(args.runs):
+                results[mode].append(
+                    summarize_page(client, mode, local_url, canonical_url)
+                )
+
+    print(f"{len(pages)} pages, {args.runs} runs each")
+    print(f"{'mode':<10} {'median s':>9} {'mean input tokens':>18} {'failures':>9}")
+    for mode, samples in results.items():
+        tokens = [s["tokens"] for s in samples if s.get("tokens") is not None]
+        failures = sum(1 for s in samples if s.get("failed"))
+        mean_tokens = f"{statistics.mean(tokens):.0f}" if tokens else "-"
+        print(
+            f"{mode:<10} {statistics.median(s['seconds'] for s in samples):>9.2f} "
+            f"{mean_tokens:>18} {failures:>5}/{len(samples)}"
+        )
+
+
+if __name__ == "__main__":
+    main()
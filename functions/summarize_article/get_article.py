@@ -1,18 +1,73 @@
+import codecs
 import datetime
 import http
 import json
-from typing import Optional
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain, zip_longest
+from email.message import Message
+from hashlib import md5
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
 
 import requests
-from fastapi.encoders import jsonable_encoder
+from appwrite.exception import AppwriteException
+from appwrite.input_file import InputFile
+from appwrite.services.storage import Storage
 from pydantic import BaseModel, Field
 from html_reader_mode import HTMLReaderMode
 
+from appwrite_client import get_client
+from article_urls import canonicalize_url
+
+ARTICLE_CONNECT_TIMEOUT_S = 5
+ARTICLE_READ_TIMEOUT_S = 10
+# Pages that take longer than this in total are cut short like oversized ones,
+# well within the 30s function timeout so there's time left to respond
+ARTICLE_DOWNLOAD_S = float(os.getenv("ARTICLE_DOWNLOAD_S", "10"))
+ARTICLE_MAX_BYTES = int(os.getenv("ARTICLE_MAX_BYTES", str(2 * 1024 * 1024)))
+ARTICLE_CHUNK_BYTES = 64 * 1024
+ARTICLE_POOL_SIZE = 16
+ARTICLE_CONTENT_BUCKET_ID = "article_content"
+# Cached articles older than this are revalidated with the publisher
+ARTICLE_CACHE_TTL_S = float(os.getenv("ARTICLE_CACHE_TTL_S", str(6 * 60 * 60)))
+ARTICLE_CACHE_SIZE = int(os.getenv("ARTICLE_CACHE_SIZE", "128"))
+PREFETCH_MAX_URLS = 25
+PREFETCH_WORKERS = int(os.getenv("PREFETCH_WORKERS", "8"))
+# Concurrent downloads from one publisher, so a batch doesn't hammer a site
+PREFETCH_PER_HOST = int(os.getenv("PREFETCH_PER_HOST", "2"))
+# Leaves time to respond within the function timeout. Downloads are cut
+# short to end by then, and pages that can't start in time are skipped.
+PREFETCH_DEADLINE_S = float(os.getenv("PREFETCH_DEADLINE_S", "20"))
+# Pages are only started with at least this long left before the deadline
+PREFETCH_MIN_DOWNLOAD_S = 2
+# Browsers only look for a <meta> charset this far into the page
+CHARSET_PRESCAN_BYTES = 1024
+META_CHARSET_RE = re.compile(rb"""<meta[^>]+charset\s*=\s*["']?\s*([\w.:-]+)""", re.I)
+BOMS = [
+    (codecs.BOM_UTF8, "utf-8"),
+    (codecs.BOM_UTF16_LE, "utf-16-le"),
+    (codecs.BOM_UTF16_BE, "utf-16-be"),
+]
+
+article_session = requests.Session()
+article_session.mount(
+    "https://", requests.adapters.HTTPAdapter(pool_maxsize=ARTICLE_POOL_SIZE)
+)
+article_session.mount(
+    "http://", requests.adapters.HTTPAdapter(pool_maxsize=ARTICLE_POOL_SIZE)
+)
+
 
 class ServerRequest(BaseModel):
     """Model for client request to serverless function"""
 
-    url: str = Field(...)
+    url: Optional[str] = Field(None)
+    urls: Optional[List[str]] = Field(None)
 
 
 class ArticleBlock(BaseModel):
@@ -33,22 +88,383 @@ class ArticleContentRes(BaseModel):
 
     status: http.HTTPStatus = Field(default=http.HTTPStatus.OK)
     data: Optional[ArticleContent] = Field(default=None)
+    url: Optional[str] = Field(default=None)
+    truncated: bool = Field(default=False)
+    etag: Optional[str] = Field(default=None)
+    last_modified: Optional[str] = Field(default=None)
+
+
+class CachedArticle(BaseModel):
+    """Extracted article kept in memory and in the article content bucket"""
+
+    url: str
+    data: ArticleContent
+    truncated: bool = False
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    fetched_at: float = Field(default_factory=time.time)
+
+    def is_fresh(self) -> bool:
+        """Check whether the article was fetched or revalidated within the TTL"""
+        return time.time() - self.fetched_at < ARTICLE_CACHE_TTL_S
+
+    def to_res(self) -> ArticleContentRes:
+        """Get the cached article as a fetch response"""
+        return ArticleContentRes(
+            data=self.data,
+            url=self.url,
+            truncated=self.truncated,
+            etag=self.etag,
+            last_modified=self.last_modified,
+        )
+
+
+class ArticleCache:
+    """Extracted articles held by this process while the instance stays warm
+
+    Holds up to max_size articles, evicting the least recently used.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.articles: "OrderedDict[str, CachedArticle]" = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0}
+        self.lock = threading.Lock()
+
+    def get(self, url_hash: str) -> Optional[CachedArticle]:
+        """Get a cached article, marking it as recently used"""
+        with self.lock:
+            article = self.articles.get(url_hash)
+            if article is None:
+                self.stats["misses"] += 1
+                return None
+            self.articles.move_to_end(url_hash)
+            self.stats["hits"] += 1
+            return article
+
+    def put(self, url_hash: str, article: CachedArticle):
+        """Cache an article, evicting the least recently used past max_size"""
+        with self.lock:
+            self.articles[url_hash] = article
+            self.articles.move_to_end(url_hash)
+            while len(self.articles) > self.max_size:
+                self.articles.popitem(last=False)
 
 
-def fetch_article_content(url: str) -> ArticleContentRes:
-    """Download article content and parse into ArticleContent"""
-    html_res = None
-    res = requests.get(url)
-    html_res = res.text
-    if html_res is None:
-        return ArticleContentRes(status=http.HTTPStatus.INTERNAL_SERVER_ERROR)
+article_cache = ArticleCache(ARTICLE_CACHE_SIZE)
+
+
+def lookup_charset(label: Optional[str]) -> Optional[str]:
+    """Get the codec for a charset label, or None if Python doesn't know it"""
+    if not label:
+        return None
+    try:
+        name = codecs.lookup(label.strip().lower()).name
+    except LookupError:
+        return None
+    # Browsers decode pages labelled latin-1 or ascii as windows-1252
+    if name in ("latin-1", "iso8859-1", "ascii"):
+        return "cp1252"
+    return name
+
+
+def detect_charset(content_type: Optional[str], body: bytes) -> str:
+    """Pick the charset to decode a page with, the way browsers do
+
+    A byte order mark wins, then the Content-Type header, then a <meta>
+    charset near the start of the page, falling back to UTF-8.
+    """
+    for bom, charset in BOMS:
+        if body.startswith(bom):
+            return charset
+    if content_type:
+        header = Message()
+        header["content-type"] = content_type
+        charset = lookup_charset(header.get_content_charset())
+        if charset:
+            return charset
+    match = META_CHARSET_RE.search(body[:CHARSET_PRESCAN_BYTES])
+    if match:
+        charset = lookup_charset(match.group(1).decode("ascii", "ignore"))
+        # A page can't describe its own encoding as UTF-16 in ASCII bytes
+        if charset and not charset.startswith("utf-16"):
+            return charset
+    return "utf-8"
+
+
+def read_limited(
+    response: requests.Response, max_bytes: int, deadline_s: float
+) -> Tuple[bytes, bool]:
+    """Read a streamed response body up to max_bytes or for deadline_s
+
+    Returns the body and whether it was cut short. The limit applies after
+    decompression, so a small compressed page can't expand past it.
+    """
+    deadline = time.monotonic() + deadline_s
+    chunks = []
+    size = 0
+    for chunk in response.iter_content(ARTICLE_CHUNK_BYTES):
+        chunks.append(chunk)
+        size += len(chunk)
+        if size >= max_bytes:
+            return b"".join(chunks)[:max_bytes], True
+        if time.monotonic() >= deadline:
+            return b"".join(chunks), True
+    return b"".join(chunks), False
+
+
+def fetch_article_content(
+    url: str,
+    max_bytes: int = ARTICLE_MAX_BYTES,
+    etag: Optional[str] = None,
+    last_modified: Optional[str] = None,
+    download_s: float = ARTICLE_DOWNLOAD_S,
+) -> ArticleContentRes:
+    """Download article content and parse into ArticleContent
+
+    The page is streamed through a session kept across warm invocations,
+    with connect and read timeouts no longer than download_s. Only the first
+    max_bytes, or what arrives within download_s of starting the request,
+    are parsed, so oversized and slow pages are truncated instead of holding
+    the function until it times out.
+    With a cached ETag or Last-Modified the request is conditional, and an
+    unchanged page returns NOT_MODIFIED without data.
+    """
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    deadline = time.monotonic() + download_s
+    with article_session.get(
+        url,
+        headers=headers,
+        stream=True,
+        timeout=(
+            min(ARTICLE_CONNECT_TIMEOUT_S, download_s),
+            min(ARTICLE_READ_TIMEOUT_S, download_s),
+        ),
+    ) as res:
+        if res.status_code == http.HTTPStatus.NOT_MODIFIED:
+            return ArticleContentRes(
+                status=http.HTTPStatus.NOT_MODIFIED,
+                url=res.url,
+                etag=res.headers.get("ETag", etag),
+                last_modified=res.headers.get("Last-Modified", last_modified),
+            )
+        content_type = res.headers.get("Content-Type")
+        if not res.ok or "html" not in (content_type or "text/html"):
+            return ArticleContentRes(
+                status=http.HTTPStatus.INTERNAL_SERVER_ERROR, url=res.url
+            )
+        body, truncated = read_limited(
+            res, max_bytes, max(0, deadline - time.monotonic())
+        )
+    html_res = body.decode(detect_charset(content_type, body), errors="replace")
 
     reader_mode = HTMLReaderMode()
     content_blocks = reader_mode.sanitize(html_res)
 
     if not content_blocks:
-        return ArticleContentRes(status=http.HTTPStatus.INTERNAL_SERVER_ERROR)
-    return ArticleContentRes(data=ArticleContent(tags=content_blocks))
+        return ArticleContentRes(
+            status=http.HTTPStatus.INTERNAL_SERVER_ERROR, url=res.url
+        )
+    return ArticleContentRes(
+        data=ArticleContent(tags=content_blocks),
+        url=res.url,
+        truncated=truncated,
+        etag=res.headers.get("ETag"),
+        last_modified=res.headers.get("Last-Modified"),
+    )
+
+
+def load_cached_article(storage: Storage, url_hash: str) -> Optional[CachedArticle]:
+    """Get an article from the content bucket, or None if it isn't stored"""
+    try:
+        stored = storage.get_file_download(ARTICLE_CONTENT_BUCKET_ID, url_hash)
+        return CachedArticle.model_validate_json(stored)
+    except Exception:
+        return None
+
+
+def store_cached_article(
+    storage: Storage, url_hash: str, article: CachedArticle, log: Callable
+):
+    """Replace an article in the content bucket
+
+    Stored files can't be rewritten, so a refreshed article replaces the
+    old file.
+    """
+    try:
+        storage.delete_file(ARTICLE_CONTENT_BUCKET_ID, url_hash)
+    except AppwriteException:
+        pass
+    try:
+        storage.create_file(
+            ARTICLE_CONTENT_BUCKET_ID,
+            url_hash,
+            InputFile.from_bytes(
+                article.model_dump_json().encode(),
+                filename=url_hash,
+                mime_type="application/json",
+            ),
+        )
+    except AppwriteException as e:
+        log(f"Failed to store article content: {e}")
+
+
+def get_article_content(
+    url: str, log: Callable, download_s: float = ARTICLE_DOWNLOAD_S
+) -> ArticleContentRes:
+    """Get an article's content from cache, downloading it on a miss
+
+    Articles are cached in this process and in the content bucket, keyed by
+    the canonical URL. Past ARTICLE_CACHE_TTL_S a cached article is
+    revalidated with its ETag or Last-Modified, and still served if the
+    publisher can't be reached. A download takes at most download_s.
+    """
+    url_hash = md5(canonicalize_url(url).encode()).hexdigest()
+    cached = article_cache.get(url_hash)
+    if cached is not None and cached.is_fresh():
+        log("Article content found in memory")
+        return cached.to_res()
+
+    storage = Storage(get_client())
+    if cached is None:
+        cached = load_cached_article(storage, url_hash)
+        if cached is not None and cached.is_fresh():
+            log("Article content found in storage")
+            article_cache.put(url_hash, cached)
+            return cached.to_res()
+
+    if cached is None:
+        res = fetch_article_content(url, download_s=download_s)
+    else:
+        log("Cached article content expired, revalidating")
+        try:
+            res = fetch_article_content(
+                url,
+                etag=cached.etag,
+                last_modified=cached.last_modified,
+                download_s=download_s,
+            )
+        except requests.RequestException as e:
+            log(f"Failed to revalidate article content, serving it stale: {e}")
+            return cached.to_res()
+
+    if res.status == http.HTTPStatus.NOT_MODIFIED and cached is not None:
+        log("Article content not modified")
+        cached = cached.model_copy(
+            update={
+                "etag": res.etag,
+                "last_modified": res.last_modified,
+                "fetched_at": time.time(),
+            }
+        )
+    elif res.data:
+        cached = CachedArticle(
+            url=res.url or url,
+            data=res.data,
+            truncated=res.truncated,
+            etag=res.etag,
+            last_modified=res.last_modified,
+        )
+    elif cached is not None:
+        log("Failed to refresh article content, serving it stale")
+        return cached.to_res()
+    else:
+        return res
+    article_cache.put(url_hash, cached)
+    store_cached_article(storage, url_hash, cached, log)
+    return cached.to_res()
+
+
+def fetch_article_contents(
+    urls: List[str],
+    log: Callable,
+    fetch: Callable[..., ArticleContentRes] = fetch_article_content,
+    workers: int = PREFETCH_WORKERS,
+    per_host: int = PREFETCH_PER_HOST,
+    deadline_s: float = PREFETCH_DEADLINE_S,
+) -> Dict[str, http.HTTPStatus]:
+    """Fetch and extract several articles concurrently, returning each status
+
+    At most per_host downloads run against the same host at once, and URLs
+    are taken from each host in turn so workers aren't all queued behind
+    one busy host. Each download is given only the time left until
+    deadline_s, passed to fetch as download_s, so every page has finished
+    when this returns. Pages that can't start with PREFETCH_MIN_DOWNLOAD_S
+    left are skipped and reported as SERVICE_UNAVAILABLE, so they can be
+    asked for again. Every URL given has a status, variants of one link
+    sharing the status of its single fetch.
+    """
+    deadline = time.monotonic() + deadline_s
+    host_limits: Dict[str, threading.BoundedSemaphore] = {}
+    host_limits_lock = threading.Lock()
+
+    def fetch_one(url: str) -> http.HTTPStatus:
+        host = urlsplit(url).netloc.lower()
+        with host_limits_lock:
+            limit = host_limits.setdefault(host, threading.BoundedSemaphore(per_host))
+        with limit:
+            remaining_s = deadline - time.monotonic()
+            if remaining_s < PREFETCH_MIN_DOWNLOAD_S:
+                return http.HTTPStatus.SERVICE_UNAVAILABLE
+            try:
+                download_s = min(ARTICLE_DOWNLOAD_S, remaining_s)
+                return fetch(url, download_s=download_s).status
+            except Exception as e:  # pylint: disable=broad-except
+                log(f"Failed to fetch article {url} {e}")
+                return http.HTTPStatus.INTERNAL_SERVER_ERROR
+
+    # Variants of the same link are fetched once
+    canonical_urls = {url: canonicalize_url(url) for url in urls}
+    unique_urls = list(
+        {canonical: url for url, canonical in canonical_urls.items()}.values()
+    )
+    if not unique_urls:
+        return {}
+    urls_by_host: Dict[str, List[str]] = {}
+    for url in unique_urls:
+        urls_by_host.setdefault(urlsplit(url).netloc.lower(), []).append(url)
+    unique_urls = [
+        url
+        for url in chain.from_iterable(zip_longest(*urls_by_host.values()))
+        if url is not None
+    ]
+    with ThreadPoolExecutor(max_workers=min(workers, len(unique_urls))) as executor:
+        statuses = {
+            canonical_urls[url]: status
+            for url, status in zip(unique_urls, executor.map(fetch_one, unique_urls))
+        }
+    return {url: statuses[canonical] for url, canonical in canonical_urls.items()}
+
+
+def prefetch(context, urls: List[str], log: Callable):
+    """Fill the article cache for a batch of URLs, responding with each status
+
+    URLs past PREFETCH_MAX_URLS aren't fetched and are reported as
+    TOO_MANY_REQUESTS.
+    """
+    statuses = dict.fromkeys(
+        urls[PREFETCH_MAX_URLS:], http.HTTPStatus.TOO_MANY_REQUESTS
+    )
+    if statuses:
+        log(f"Prefetching the first {PREFETCH_MAX_URLS} of {len(urls)} articles")
+    statuses.update(
+        fetch_article_contents(
+            urls[:PREFETCH_MAX_URLS],
+            log,
+            fetch=lambda url, download_s: get_article_content(url, log, download_s),
+        )
+    )
+    fetched = sum(1 for status in statuses.values() if status == http.HTTPStatus.OK)
+    log(f"Prefetched {fetched} of {len(statuses)} articles")
+    log(f"Article cache in this process {article_cache.stats}")
+    return context.res.json(
+        {"results": {url: status.value for url, status in statuses.items()}},
+        statusCode=http.HTTPStatus.OK,
+    )
 
 
 def main(context):
@@ -61,16 +477,24 @@ def main(context):
     req_body = json.loads(context.req.body)
     log(f"Got request body {req_body}")
     req_data = ServerRequest(**req_body)
+    if req_data.urls is not None:
+        return prefetch(context, req_data.urls, log)
+    if req_data.url is None:
+        return context.res.json(
+            {"message": "Missing url"}, statusCode=http.HTTPStatus.BAD_REQUEST
+        )
 
     log("Fetching article source...")
     try:
-        res_data = fetch_article_content(req_data.url)
+        res_data = get_article_content(req_data.url, log)
     except Exception as e:  # pylint: disable=broad-except
         log("Exception occurred fetching data")
         return context.res.json(
             {"message": str(e)}, statusCode=http.HTTPStatus.INTERNAL_SERVER_ERROR
         )
     log("Finished fetching data")
+    if res_data.truncated:
+        log("Article was cut short at the download limit")
 
     if not res_data.data:
         log("No data fetched")
@@ -79,6 +503,7 @@ def main(context):
             statusCode=http.HTTPStatus.INTERNAL_SERVER_ERROR,
         )
 
-    json_data = jsonable_encoder(res_data.data)
+    json_data = res_data.data.model_dump(mode="json")
+    log(f"Article cache in this process {article_cache.stats}")
     log("Returning json data")
     return context.res.json({"data": json_data}, statusCode=http.HTTPStatus.OK)
@@ -2,21 +2,46 @@
 
 import json
 import os
+import random
+import threading
+import time
+from collections import OrderedDict
 from hashlib import md5
-from typing import Optional
+from typing import Any, Callable, Dict, Optional, Tuple
+from urllib.parse import urlsplit
 
-from appwrite.client import Client
+from appwrite.exception import AppwriteException
 from appwrite.input_file import InputFile
 from appwrite.services.databases import Databases
 from appwrite.services.storage import Storage
 from pydantic import BaseModel, Field
-from google import genai
-from google.genai import types
 
-PROJECT_ID = "67cccd44002cccfc9ae0"
+from appwrite_client import connection_stats, get_client
+from article_urls import canonicalize_url
+from summaries import (
+    SUMMARY_DOWNLOAD_S,
+    SUMMARY_MODE,
+    acquire_summary_lease,
+    extract_article_text,
+    release_summary_lease,
+    request_summary,
+)
+
 FEEDS_DATABASE_ID = "6466af38420c3ca601c1"
 NEWS_ARTICLES_COLLECTION_ID = "6797ac2e001706792636"
 SUMMARY_BUCKET_ID = "664bcddf002e5c7eba87"
+URL_REDIRECTS_COLLECTION_ID = "url_redirects"
+SUMMARY_WAIT_S = float(os.getenv("SUMMARY_WAIT_S", "20"))
+# Matches the timeout in appwrite.json, requests are planned to finish within it
+FUNCTION_TIMEOUT_S = 30
+# Time set aside for Gemini and storage after the SUMMARY_DOWNLOAD_S article
+# download. Waiting for another request's summary stops early enough to leave
+# both.
+SUMMARY_GENERATE_S = float(os.getenv("SUMMARY_GENERATE_S", "10"))
+WAIT_INITIAL_DELAY_S = 0.5
+WAIT_MAX_DELAY_S = 4
+SUMMARY_CACHE_SIZE = int(os.getenv("SUMMARY_CACHE_SIZE", "256"))
+FAILED_SUMMARY_TTL_S = float(os.getenv("FAILED_SUMMARY_TTL_S", "300"))
 
 
 class ServerRequest(BaseModel):
@@ -27,56 +52,285 @@ class ServerRequest(BaseModel):
     article_id: Optional[str] = Field(None)
 
 
+class SummaryCache:
+    """Summaries served by this process, kept while the instance stays warm
+
+    Holds up to max_size summaries, evicting the least recently used, and
+    remembers URLs whose summary failed for failure_ttl_s so retries don't
+    go straight back to Gemini.
+    """
+
+    def __init__(self, max_size: int, failure_ttl_s: float):
+        self.max_size = max_size
+        self.failure_ttl_s = failure_ttl_s
+        self.summaries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.failures: Dict[str, float] = {}
+        self.stats = {"hits": 0, "misses": 0, "negative_hits": 0}
+        self.lock = threading.Lock()
+
+    def get(self, url_hash: str) -> Optional[Dict[str, Any]]:
+        """Get a cached summary, marking it as recently used"""
+        with self.lock:
+            summary = self.summaries.get(url_hash)
+            if summary is None:
+                self.stats["misses"] += 1
+                return None
+            self.summaries.move_to_end(url_hash)
+            self.stats["hits"] += 1
+            return summary
+
+    def put(self, url_hash: str, summary: Dict[str, Any]):
+        """Cache a summary, evicting the least recently used past max_size"""
+        with self.lock:
+            self.failures.pop(url_hash, None)
+            self.summaries[url_hash] = summary
+            self.summaries.move_to_end(url_hash)
+            while len(self.summaries) > self.max_size:
+                self.summaries.popitem(last=False)
+
+    def record_failure(self, url_hash: str):
+        """Remember that generating a summary just failed"""
+        now = time.monotonic()
+        with self.lock:
+            if len(self.failures) >= self.max_size:
+                self.failures = {
+                    key: expires_at
+                    for key, expires_at in self.failures.items()
+                    if expires_at > now
+                }
+            self.failures[url_hash] = now + self.failure_ttl_s
+
+    def failed_recently(self, url_hash: str) -> bool:
+        """Check whether generating a summary failed within the failure TTL"""
+        with self.lock:
+            expires_at = self.failures.get(url_hash)
+            if expires_at is None:
+                return False
+            if expires_at <= time.monotonic():
+                del self.failures[url_hash]
+                return False
+            self.stats["negative_hits"] += 1
+            return True
+
+
+summary_cache = SummaryCache(SUMMARY_CACHE_SIZE, FAILED_SUMMARY_TTL_S)
+
+
+def url_hash_of(url: str) -> str:
+    """Hash a URL into the ID its summary and redirect are stored under"""
+    return md5(url.encode()).hexdigest()
+
+
+def resolve_known_redirect(databases: Databases, article_url: str) -> Optional[str]:
+    """Get where a canonical URL is known to redirect, or None"""
+    try:
+        redirect = databases.get_document(
+            FEEDS_DATABASE_ID, URL_REDIRECTS_COLLECTION_ID, url_hash_of(article_url)
+        )
+    except AppwriteException:
+        return None
+    return redirect["target_url"]
+
+
+def is_article_redirect(source_url: str, target_url: str) -> bool:
+    """Check whether a download that ended on target_url moved to another article
+
+    Pages redirected to a site's homepage, usually a consent or login wall,
+    aren't the article and would alias every article from the site.
+    """
+    return target_url != source_url and urlsplit(target_url).path not in ("", "/")
+
+
+def record_redirect(
+    databases: Databases, source_url: str, target_url: str, log: Callable
+):
+    """Remember where a canonical URL redirects, as an alias for its summary"""
+    try:
+        databases.create_document(
+            FEEDS_DATABASE_ID,
+            URL_REDIRECTS_COLLECTION_ID,
+            url_hash_of(source_url),
+            {"source_url": source_url, "target_url": target_url},
+        )
+    except AppwriteException as e:
+        if e.code != 409:
+            log(f"Failed to record redirect: {e}")
+
+
+def get_cached_summary(storage: Storage, url_hash: str) -> Optional[Dict[str, Any]]:
+    """Get a stored summary, or None if the article hasn't been summarized yet"""
+    try:
+        return json.loads(storage.get_file_download(SUMMARY_BUCKET_ID, url_hash))
+    except Exception:
+        return None
+
+
+def claim_summary(
+    databases: Databases,
+    storage: Storage,
+    url_hash: str,
+    log: Callable,
+    wait_s: float = SUMMARY_WAIT_S,
+) -> Tuple[bool, Optional[Dict[str, Any]]]:
+    """Take the lease on generating a summary, or wait for the request holding it
+
+    Returns whether this request holds the lease, and the summary if it was
+    stored while waiting. Storage is polled with exponential backoff and
+    jitter, and after wait_s neither is returned.
+    """
+    deadline = time.monotonic() + wait_s
+    delay_s = WAIT_INITIAL_DELAY_S
+    while True:
+        if acquire_summary_lease(databases, url_hash, log):
+            # The last holder may have stored its summary since the first check
+            return True, get_cached_summary(storage, url_hash)
+        remaining_s = deadline - time.monotonic()
+        if remaining_s <= 0:
+            return False, None
+        time.sleep(min(remaining_s, delay_s * random.uniform(0.5, 1)))
+        delay_s = min(WAIT_MAX_DELAY_S, delay_s * 2)
+        summary = get_cached_summary(storage, url_hash)
+        if summary is not None:
+            return False, summary
+
+
 def main(context):
     """Summarize an article using Google Gemini 2.5 Flash Lite."""
+    try:
+        return context.res.json(summarize(context))
+    finally:
+        context.log(f"Summary cache in this process {summary_cache.stats}")
+
+
+def summarize(context) -> Dict[str, Any]:
+    """Get an article's summary from cache or storage, generating it on a miss"""
+    deadline = time.monotonic() + FUNCTION_TIMEOUT_S
     context.log("Initializing appwrite client")
     req_body = json.loads(context.req.body)
     req_data = ServerRequest(**req_body)
 
-    appwrite_client = Client()
-    appwrite_client.set_key(os.getenv("APPWRITE_API_KEY"))
-    appwrite_client.set_endpoint("https://appwrite.liammasters.space/v1")
-    appwrite_client.set_project(PROJECT_ID)
+    # Variants of one link share a summary, keyed by the canonical URL
+    article_url = canonicalize_url(req_data.article_url)
+    url_hash = url_hash_of(article_url)
+    summary = summary_cache.get(url_hash)
+    if summary is not None:
+        context.log("Summary found in memory, returning")
+        return summary
+
+    appwrite_client = get_client()
+    context.log(f"Appwrite connections in this process {connection_stats()}")
 
     database = Databases(appwrite_client)
 
     context.log("Checking if article has already been summarized")
-    url_hash = md5(req_data.article_url.encode()).hexdigest()
     summaries = Storage(appwrite_client)
-    try:
-        summary = summaries.get_file_download(SUMMARY_BUCKET_ID, url_hash)
+    summary = get_cached_summary(summaries, url_hash)
+    if summary is None:
+        # The article it redirects to may have been summarized under its own URL
+        target_url = resolve_known_redirect(database, article_url)
+        if target_url is not None:
+            summary = get_cached_summary(summaries, url_hash_of(target_url))
+    legacy_hash = url_hash_of(req_data.article_url)
+    if summary is None and legacy_hash != url_hash:
+        # Summaries stored before canonical URLs are keyed by the raw URL
+        summary = get_cached_summary(summaries, legacy_hash)
+    if summary is not None:
         context.log("Summary found in storage, returning")
-        return context.res.json(summary)
-    except Exception:
-        context.log("No summary found, generating one")
+        summary_cache.put(url_hash, summary)
+        return summary
+    if summary_cache.failed_recently(url_hash):
+        context.log("Summary failed recently, not retrying yet")
+        return {"error": "Failed to generate article summary"}
+    context.log("No summary found, generating one")
 
-    context.log("Getting article summary from Gemini")
+    # Concurrent requests for the same article wait for one Gemini call
+    wait_s = min(
+        SUMMARY_WAIT_S,
+        deadline - time.monotonic() - SUMMARY_DOWNLOAD_S - SUMMARY_GENERATE_S,
+    )
+    holds_lease, summary = claim_summary(
+        database, summaries, url_hash, context.log, max(0, wait_s)
+    )
+    if summary is not None:
+        context.log("Summary generated by another request, returning")
+        if holds_lease:
+            release_summary_lease(database, url_hash, context.log)
+        summary_cache.put(url_hash, summary)
+        return summary
+    if not holds_lease:
+        context.log("Timed out waiting for another request to generate the summary")
+        return {"error": "Summary is still being generated, try again shortly"}
     try:
-        client = genai.Client(api_key=os.getenv("GOOGLE_GEMINI_API_KEY"))
-        grounding_tool = types.Tool(google_search=types.GoogleSearch())
-
-        config = types.GenerateContentConfig(tools=[grounding_tool])
-
-        response = client.models.generate_content(
-            model="gemini-2.5-flash-lite",
-            contents="Summarize the following article, highlighting the main points "
-            "and providing key takeaways. Keep the summary to one paragraph to make it "
-            "digestible for readers, breaking it up into bullet points. Avoid any prose "
-            "that isn't directly summarizing the article. Return the summary formatted "
-            f"as markdown\n\n {req_data.article_url}",
-            config=config,
+        summary = generate_summary(
+            context, req_data, article_url, database, summaries, url_hash, deadline
         )
+    finally:
+        release_summary_lease(database, url_hash, context.log)
+    if "error" in summary:
+        summary_cache.record_failure(url_hash)
+    else:
+        summary_cache.put(url_hash, summary)
+    return summary
+
+
+def generate_summary(
+    context,
+    req_data: ServerRequest,
+    article_url: str,
+    database: Databases,
+    summaries: Storage,
+    url_hash: str,
+    deadline: float,
+) -> Dict[str, Any]:
+    """Generate a summary with Gemini and store it, returning the response body
+
+    The summary is stored under url_hash, the hash of the canonical
+    article_url that waiting requests poll for. When the article text is
+    extracted from a different article page, the redirect is recorded so
+    that page's URL finds this summary too. The article download is cut
+    short to leave SUMMARY_GENERATE_S before deadline, the monotonic time
+    the request should be done by.
+    """
+    article_text = None
+    if SUMMARY_MODE == "extracted":
+        context.log("Extracting article text")
+        try:
+            # Whatever is left after keeping time for Gemini, up to the usual
+            # download budget
+            download_s = min(
+                SUMMARY_DOWNLOAD_S,
+                deadline - time.monotonic() - SUMMARY_GENERATE_S,
+            )
+            article_text, final_url = extract_article_text(
+                req_data.article_url, context.log, download_s=max(1, download_s)
+            )
+            final_url = canonicalize_url(final_url)
+            if article_text is not None and is_article_redirect(
+                article_url, final_url
+            ):
+                context.log(f"Article redirects to {final_url}")
+                record_redirect(database, article_url, final_url, context.log)
+        except Exception as e:
+            context.log(f"Failed to extract article text: {e}")
+        if article_text is None:
+            context.log("No article text extracted, using search grounding")
+
+    context.log("Getting article summary from Gemini")
+    try:
+        summary_text, usage = request_summary(req_data.article_url, article_text)
+        if usage:
+            context.log(
+                f"Gemini used {usage.prompt_token_count} input "
+                f"and {usage.total_token_count} total tokens"
+            )
 
-        summary_text = response.text
         context.log("Generated summary using Gemini")
         if not summary_text:
             context.log("No summary text generated by Gemini")
-            return context.res.json(
-                {"error": "Failed to generate article summary - empty response"}
-            )
+            return {"error": "Failed to generate article summary - empty response"}
     except Exception as e:
         context.log(f"Failed to summarize article: {e}")
-        return context.res.json({"error": "Failed to generate article summary"})
+        return {"error": "Failed to generate article summary"}
 
     context.log("Generated summary, uploading to storage")
     summary = {"summary": summary_text}
@@ -108,4 +362,4 @@ def main(context):
             context.log(f"Failed to update article with summary: {e}")
 
     context.log("Returning summary")
-    return context.res.json(summary)
+    return summary
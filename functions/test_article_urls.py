@@ -0,0 +1,60 @@
+import pytest
+
+from article_urls import canonicalize_url
+
+
+@pytest.mark.parametrize(
+    "url, canonical",
+    [
+        (
+            "http://www.Example.com:80/story?utm_source=rss&id=7&fbclid=x#comments",
+            "https://example.com/story?id=7",
+        ),
+        (
+            "https://example.com/story?b=2&a=1&UTM_Medium=email",
+            "https://example.com/story?a=1&b=2",
+        ),
+        ("https://example.com:8443/story", "https://example.com:8443/story"),
+        ("https://example.com", "https://example.com/"),
+        ("https://example.com./story", "https://example.com/story"),
+    ],
+)
+def test_canonical_url_drops_tracking_and_host_variations(url, canonical):
+    assert canonicalize_url(url) == canonical
+
+
+@pytest.mark.parametrize(
+    "url",
+    [
+        "https://example.com/story/amp",
+        "https://example.com/story/amp/",
+        "https://amp.example.com/story",
+        "https://example.com/story?amp=1",
+        "https://example.com/story?outputType=amp",
+        "https://example-com.cdn.ampproject.org/c/s/example.com/story/amp",
+        "https://example-com.cdn.ampproject.org/v/s/www.example.com/story",
+    ],
+)
+def test_amp_variants_map_to_the_regular_page(url):
+    assert canonicalize_url(url) == "https://example.com/story"
+
+
+def test_bare_amp_path_is_kept():
+    assert canonicalize_url("https://example.com/amp") == "https://example.com/amp"
+
+
+def test_amp_html_keeps_its_extension():
+    assert canonicalize_url("https://example.com/story.amp.html") == (
+        "https://example.com/story.html"
+    )
+    assert canonicalize_url("https://example.com/story/amp.html") == (
+        "https://example.com/story.html"
+    )
+
+
+@pytest.mark.parametrize(
+    "url",
+    ["mailto:news@example.com", "ftp://example.com/story", "https://example.com:x/"],
+)
+def test_other_urls_are_unchanged(url):
+    assert canonicalize_url(url) == url
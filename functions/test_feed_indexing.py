@@ -0,0 +1,100 @@
+import datetime
+
+from feed_indexing import HighWaterMark, HighWaterMarkScan, html_to_text
+
+
+def entry(number, day):
+    published = datetime.datetime(2024, 1, day, tzinfo=datetime.timezone.utc)
+    return {
+        "id": f"entry-{number}",
+        "published": published.strftime("%a, %d %b %Y %H:%M:%S +0000"),
+    }
+
+
+def scan(entries, mark):
+    high_water_mark_scan = HighWaterMarkScan(mark)
+    unseen = []
+    for item in entries:
+        if high_water_mark_scan.reached_mark(item):
+            break
+        unseen.append(item["id"])
+    return high_water_mark_scan, unseen
+
+
+def test_scan_stops_at_the_marked_guid():
+    mark = HighWaterMark(guid="entry-3")
+    entries = [entry(number, day=10) for number in range(5, 0, -1)]
+
+    high_water_mark_scan, unseen = scan(entries, mark)
+    assert unseen == ["entry-5", "entry-4"]
+    assert high_water_mark_scan.reached
+    assert high_water_mark_scan.next_mark().guid == "entry-5"
+
+
+def test_scan_stops_before_the_marked_pub_date():
+    mark = HighWaterMark(
+        pub_date=datetime.datetime(2024, 1, 3, tzinfo=datetime.timezone.utc),
+        guid="removed-entry",
+    )
+    entries = [entry(number, number) for number in range(5, 0, -1)]
+
+    high_water_mark_scan, unseen = scan(entries, mark)
+    assert unseen == ["entry-5", "entry-4", "entry-3"]
+    assert high_water_mark_scan.next_mark().pub_date.day == 5
+    assert high_water_mark_scan.publish_gap_minutes() == 24 * 60
+
+
+def test_scan_of_out_of_order_feed_reads_everything_and_flags_it():
+    mark = HighWaterMark(guid="entry-2")
+    entries = [entry(number, number) for number in [3, 4, 2, 1]]
+
+    high_water_mark_scan, unseen = scan(entries, mark)
+    assert unseen == ["entry-3", "entry-4", "entry-2", "entry-1"]
+    assert high_water_mark_scan.next_mark() == HighWaterMark(out_of_order=True)
+
+
+def test_scan_checked_up_front_ignores_the_mark():
+    mark = HighWaterMark(guid="entry-5")
+    entries = [entry(number, number) for number in [5, 4, 6]]
+    high_water_mark_scan = HighWaterMarkScan(mark)
+    high_water_mark_scan.check_feed_order(entries)
+
+    assert not high_water_mark_scan.reached_mark(entries[0])
+    assert not high_water_mark_scan.trusts_order
+
+
+def test_scan_keeps_the_mark_after_failed_writes():
+    mark = HighWaterMark(guid="entry-1")
+    high_water_mark_scan, _ = scan([entry(2, 2), entry(1, 1)], mark)
+    high_water_mark_scan.writes_failed = True
+
+    assert high_water_mark_scan.next_mark() is None
+
+
+def test_scan_keeps_a_newer_mark():
+    mark = HighWaterMark(
+        pub_date=datetime.datetime(2024, 1, 9, tzinfo=datetime.timezone.utc)
+    )
+    high_water_mark_scan = HighWaterMarkScan(mark)
+    high_water_mark_scan.newest = HighWaterMark(
+        pub_date=datetime.datetime(2024, 1, 5, tzinfo=datetime.timezone.utc)
+    )
+
+    assert high_water_mark_scan.next_mark() is None
+
+
+def test_html_to_text_strips_tags_and_entities():
+    markup = "<p>Fish &amp; <b>chips</b></p><script>track()</script><p>&lt;3</p>"
+
+    assert html_to_text(markup) == "Fish &  chips <3"
+
+
+def test_html_to_text_without_tags():
+    assert html_to_text("Fish &amp; chips") == "Fish & chips"
+    assert html_to_text("plain text", limit=5) == "plain"
+
+
+def test_html_to_text_stops_at_the_limit():
+    markup = "<p>first</p>" + "<p>more</p>" * 1000
+
+    assert html_to_text(markup, limit=8) == "first mo"
@@ -35,6 +35,20 @@ def test_index_podcasts():
     get_podcasts_main(execution_context)
 
 
+def test_index_articles_batch():
+    execution_context = context_mock(
+        {"feed_ids": ["679d73a90032e2473101"], "feed_workers": 2}
+    )
+    get_news_main(execution_context)
+
+
+def test_index_podcasts_batch():
+    execution_context = context_mock(
+        {"feed_ids": ["c35326904cd87224f69358f4a6a57d35"], "feed_workers": 2}
+    )
+    get_podcasts_main(execution_context)
+
+
 def test_parse_article():
     execution_context = context_mock(
         {
@@ -0,0 +1,210 @@
+import codecs
+import http
+import time
+from hashlib import md5
+
+import pytest
+import requests
+from appwrite.exception import AppwriteException
+
+import get_article
+from article_urls import canonicalize_url
+from get_article import (
+    ARTICLE_CACHE_TTL_S,
+    ArticleBlock,
+    ArticleCache,
+    ArticleContent,
+    ArticleContentRes,
+    CachedArticle,
+    detect_charset,
+    fetch_article_content,
+    get_article_content,
+)
+
+URL = "https://example.com/story"
+
+
+@pytest.mark.parametrize(
+    "content_type, body, charset",
+    [
+        ("text/html; charset=ISO-8859-1", b"<html>", "cp1252"),
+        ("text/html; charset=utf-8", b'<meta charset="shift_jis">', "utf-8"),
+        ("text/html", b'<head><meta charset="Shift_JIS"></head>', "shift_jis"),
+        (
+            None,
+            b'<meta http-equiv="Content-Type" content="text/html; charset=koi8-r">',
+            "koi8-r",
+        ),
+        ("text/html; charset=nonsense", b"<html>", "utf-8"),
+        ("text/html", b'<meta charset="utf-16">', "utf-8"),
+        ("text/html", b" " * 2000 + b'<meta charset="shift_jis">', "utf-8"),
+        ("text/html; charset=shift_jis", codecs.BOM_UTF8 + b"<html>", "utf-8"),
+    ],
+)
+def test_detect_charset(content_type, body, charset):
+    assert detect_charset(content_type, body) == charset
+
+
+def article(fetched_at=None):
+    return CachedArticle(
+        url=URL,
+        data=ArticleContent(tags=[ArticleBlock(tag="p", content="Cached text")]),
+        etag='"v1"',
+        last_modified="Mon, 01 Jan 2024 00:00:00 GMT",
+        fetched_at=time.time() if fetched_at is None else fetched_at,
+    )
+
+
+def test_cached_article_goes_stale_after_the_ttl():
+    assert article().is_fresh()
+    assert not article(fetched_at=time.time() - ARTICLE_CACHE_TTL_S - 1).is_fresh()
+
+
+def test_article_cache_evicts_the_least_recently_used():
+    cache = ArticleCache(max_size=2)
+    cache.put("first", article())
+    cache.put("second", article())
+    cache.get("first")
+    cache.put("third", article())
+
+    assert cache.get("second") is None
+    assert cache.get("first") is not None
+    assert cache.stats == {"hits": 2, "misses": 1}
+
+
+class FakeStorage:
+    def __init__(self, client=None):
+        self.files = {}
+
+    def get_file_download(self, bucket_id, file_id):
+        if file_id not in self.files:
+            raise AppwriteException("File not found", 404)
+        return self.files[file_id]
+
+    def delete_file(self, bucket_id, file_id):
+        if self.files.pop(file_id, None) is None:
+            raise AppwriteException("File not found", 404)
+
+    def create_file(self, bucket_id, file_id, file):
+        self.files[file_id] = file.data
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    storage = FakeStorage()
+    cache = ArticleCache(max_size=4)
+    monkeypatch.setattr(get_article, "article_cache", cache)
+    monkeypatch.setattr(get_article, "Storage", lambda client: storage)
+    monkeypatch.setattr(get_article, "get_client", lambda: None)
+    return cache
+
+
+def url_hash(url):
+    return md5(canonicalize_url(url).encode()).hexdigest()
+
+
+def fake_fetch(monkeypatch, res):
+    calls = []
+
+    def fetch(url, **kwargs):
+        calls.append(kwargs)
+        if isinstance(res, Exception):
+            raise res
+        return res
+
+    monkeypatch.setattr(get_article, "fetch_article_content", fetch)
+    return calls
+
+
+def test_fresh_article_is_served_from_memory(cache, monkeypatch):
+    calls = fake_fetch(
+        monkeypatch, ArticleContentRes(data=article().data, url=URL, etag='"v1"')
+    )
+
+    get_article_content(URL + "?utm_source=rss", lambda message: None)
+    res = get_article_content(URL, lambda message: None)
+    assert len(calls) == 1
+    assert res.data.tags[0].content == "Cached text"
+
+
+def test_expired_article_is_revalidated(cache, monkeypatch):
+    calls = fake_fetch(
+        monkeypatch,
+        ArticleContentRes(
+            status=http.HTTPStatus.NOT_MODIFIED,
+            url=URL,
+            etag='"v1"',
+            last_modified="Mon, 01 Jan 2024 00:00:00 GMT",
+        ),
+    )
+    cache.put(url_hash(URL), article(fetched_at=0))
+
+    res = get_article_content(URL, lambda message: None)
+    assert calls == [
+        {
+            "etag": '"v1"',
+            "last_modified": "Mon, 01 Jan 2024 00:00:00 GMT",
+            "download_s": get_article.ARTICLE_DOWNLOAD_S,
+        }
+    ]
+    assert res.status == http.HTTPStatus.OK
+    assert res.data.tags[0].content == "Cached text"
+    assert cache.get(url_hash(URL)).is_fresh()
+
+
+def test_expired_article_is_served_stale_when_the_publisher_fails(cache, monkeypatch):
+    calls = fake_fetch(
+        monkeypatch,
+        ArticleContentRes(status=http.HTTPStatus.INTERNAL_SERVER_ERROR, url=URL),
+    )
+    cache.put(url_hash(URL), article(fetched_at=0))
+
+    res = get_article_content(URL, lambda message: None)
+    assert len(calls) == 1
+    assert res.data.tags[0].content == "Cached text"
+    assert not cache.get(url_hash(URL)).is_fresh()
+
+
+def test_expired_article_is_served_stale_when_the_publisher_is_down(cache, monkeypatch):
+    fake_fetch(monkeypatch, requests.ConnectionError("down"))
+    cache.put(url_hash(URL), article(fetched_at=0))
+
+    res = get_article_content(URL, lambda message: None)
+    assert res.data.tags[0].content == "Cached text"
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers):
+        self.status_code = status_code
+        self.headers = headers
+        self.url = URL
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+def test_conditional_request_returns_not_modified(monkeypatch):
+    sent_headers = []
+
+    def get(url, headers, **kwargs):
+        sent_headers.append(headers)
+        return FakeResponse(304, {"ETag": '"v2"'})
+
+    monkeypatch.setattr(get_article.article_session, "get", get)
+
+    res = fetch_article_content(
+        URL, etag='"v1"', last_modified="Mon, 01 Jan 2024 00:00:00 GMT"
+    )
+    assert sent_headers == [
+        {
+            "If-None-Match": '"v1"',
+            "If-Modified-Since": "Mon, 01 Jan 2024 00:00:00 GMT",
+        }
+    ]
+    assert res.status == http.HTTPStatus.NOT_MODIFIED
+    assert res.data is None
+    assert res.etag == '"v2"'
+    assert res.last_modified == "Mon, 01 Jan 2024 00:00:00 GMT"
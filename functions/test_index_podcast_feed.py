@@ -0,0 +1,115 @@
+import datetime
+import io
+
+import pytest
+
+from feed_indexing import HighWaterMark, HighWaterMarkScan
+from index_podcast_feed import NotRSSFeed, RSSItemStream, index_podcast_entries
+
+
+def rss(episodes):
+    items = "".join(
+        f"""<item>
+            <title>Ep{number}</title>
+            <guid>ep-{number}</guid>
+            <pubDate>{published}</pubDate>
+            <enclosure url="https://example.com/ep{number}.mp3" type="audio/mpeg"/>
+        </item>"""
+        for number, published in episodes
+    )
+    return f"""<?xml version="1.0"?>
+        <rss version="2.0"><channel><title>Podcast</title>{items}</channel></rss>
+    """.encode()
+
+
+def rfc822(date):
+    return date.strftime("%a, %d %b %Y %H:%M:%S +0000")
+
+
+def pub_date(day):
+    return rfc822(datetime.datetime(2024, 1, day, tzinfo=datetime.timezone.utc))
+
+
+def index(databases, document, mark):
+    scan = HighWaterMarkScan(mark)
+    stream = RSSItemStream(io.BytesIO(document))
+    responses, _ = index_podcast_entries(
+        iter(stream), lambda: None, scan, databases, "feed", lambda message: None
+    )
+    return responses, scan.next_mark()
+
+
+def test_oldest_first_feed_indexes_episodes_added_at_the_end(databases):
+    episodes = [(number, pub_date(number)) for number in range(1, 6)]
+
+    responses, mark = index(databases, rss(episodes[:3]), HighWaterMark())
+    assert len(responses) == 3
+    assert mark == HighWaterMark(out_of_order=True)
+
+    responses, mark = index(databases, rss(episodes), mark)
+    assert len(databases.created) == 5
+    assert responses.count(200) == 2
+    assert mark.out_of_order
+
+
+def test_newest_first_feed_stops_at_the_mark(databases):
+    episodes = [(number, pub_date(number)) for number in range(5, 0, -1)]
+
+    _, mark = index(databases, rss(episodes[2:]), HighWaterMark())
+    assert mark.pub_date.day == 3 and not mark.out_of_order
+
+    responses, mark = index(databases, rss(episodes), mark)
+    assert responses == [200, 200]
+    assert mark.pub_date.day == 5
+
+
+def test_feed_back_in_order_gets_a_mark_again(databases):
+    episodes = [(number, pub_date(number)) for number in range(3, 0, -1)]
+
+    responses, mark = index(
+        databases, rss(episodes), HighWaterMark(out_of_order=True)
+    )
+    assert responses == [200, 200, 200]
+    assert mark.pub_date.day == 3 and not mark.out_of_order
+
+
+def test_oldest_first_feed_reads_past_the_max_episode_age(databases, monkeypatch):
+    import index_podcast_feed
+
+    monkeypatch.setattr(index_podcast_feed, "MAX_EPISODE_AGE_DAYS", 30)
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    episodes = [
+        (number, rfc822(now - datetime.timedelta(days=age)))
+        for number, age in [(1, 90), (2, 60), (3, 1)]
+    ]
+
+    responses, mark = index(databases, rss(episodes), HighWaterMark())
+    assert responses == [200]
+    assert mark.out_of_order
+
+
+def test_atom_feed_is_handed_back_whole():
+    document = b"""<?xml version="1.0"?>
+        <feed xmlns="http://www.w3.org/2005/Atom"><title>Podcast</title></feed>
+    """
+    stream = RSSItemStream(io.BytesIO(document))
+
+    with pytest.raises(NotRSSFeed):
+        list(stream)
+    assert stream.read_document() == document
+
+
+def test_malformed_document_before_any_item_is_not_rss():
+    stream = RSSItemStream(io.BytesIO(b"<rss><channel><title>Podcast</chan"))
+
+    with pytest.raises(NotRSSFeed):
+        list(stream)
+
+
+def test_malformed_document_after_items_keeps_them():
+    document = rss([(1, pub_date(1))]).replace(b"</channel></rss>", b"<item><ti")
+    stream = RSSItemStream(io.BytesIO(document))
+
+    entries = list(stream)
+    assert [entry["id"] for entry in entries] == ["ep-1"]
+    assert stream.error is not None
@@ -0,0 +1,104 @@
+import scheduler
+from scheduler import (
+    MAX_UPDATE_INTERVAL_MINUTES,
+    MIN_UPDATE_INTERVAL_MINUTES,
+    TokenBucket,
+    adapt_update_interval,
+    shard_feeds,
+)
+
+
+def feed(feed_id, host, cost=None):
+    return {
+        "$id": feed_id,
+        "rss_url": f"https://{host}/{feed_id}.xml",
+        "last_index_ms": cost,
+    }
+
+
+def test_shards_hold_at_most_shard_size_feeds():
+    feeds = [feed(f"feed-{number}", f"host-{number}.com") for number in range(7)]
+
+    shards = shard_feeds(feeds, shard_size=3, cost_budget_ms=10**9)
+    assert [len(feed_ids) for feed_ids, _ in shards] == [3, 3, 1]
+    assert all(limits == {} for _, limits in shards)
+
+
+def test_shards_fill_up_to_the_cost_budget():
+    feeds = [
+        feed("slow", "a.com", cost=9000),
+        feed("medium", "b.com", cost=6000),
+        feed("fast", "c.com", cost=3000),
+    ]
+
+    shards = shard_feeds(feeds, shard_size=10, cost_budget_ms=10000)
+    assert [feed_ids for feed_ids, _ in shards] == [["slow"], ["medium", "fast"]]
+
+
+def test_host_split_over_shards_shares_its_limit():
+    feeds = [feed(f"feed-{number}", "big.com") for number in range(7)]
+
+    shards = shard_feeds(feeds, shard_size=3, cost_budget_ms=10**9, max_per_host=4)
+    assert sorted(len(feed_ids) for feed_ids, _ in shards) == [1, 3, 3]
+    limits = [shard_limits["big.com"] for _, shard_limits in shards]
+    assert sum(limits) == 4
+    assert min(limits) >= 1
+
+
+def test_host_past_its_limit_leaves_feeds_due():
+    feeds = [feed(f"feed-{number}", "big.com") for number in range(10)]
+
+    shards = shard_feeds(feeds, shard_size=2, cost_budget_ms=10**9, max_per_host=3)
+    assert sum(len(feed_ids) for feed_ids, _ in shards) == 6
+    assert [limits["big.com"] for _, limits in shards] == [1, 1, 1]
+
+
+def test_update_interval_without_a_result_is_kept():
+    assert adapt_update_interval(60, None, None) == 60
+
+
+def test_update_interval_backs_off_when_quiet():
+    assert adapt_update_interval(60, 0, None) == 120
+    assert adapt_update_interval(MAX_UPDATE_INTERVAL_MINUTES, 0, None) == (
+        MAX_UPDATE_INTERVAL_MINUTES
+    )
+
+
+def test_update_interval_speeds_up_with_new_items():
+    assert adapt_update_interval(240, 5, None) == 120
+    assert adapt_update_interval(240, 5, 45) == 45
+    assert adapt_update_interval(MIN_UPDATE_INTERVAL_MINUTES, 5, 1) == (
+        MIN_UPDATE_INTERVAL_MINUTES
+    )
+
+
+def test_update_interval_moves_toward_the_publish_gap():
+    assert adapt_update_interval(240, 1, 120) == 180
+    assert adapt_update_interval(240, 1, None) == 240
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def test_token_bucket_allows_a_burst_then_waits(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(scheduler, "time", clock)
+    bucket = TokenBucket(rate=2, capacity=3)
+
+    for _ in range(3):
+        bucket.acquire()
+    assert clock.sleeps == []
+
+    bucket.acquire()
+    assert clock.sleeps == [0.5]
+    assert clock.now == 0.5
@@ -0,0 +1,50 @@
+from summarize import SummaryCache
+
+
+def test_failed_summary_is_remembered_until_its_ttl():
+    cache = SummaryCache(max_size=4, failure_ttl_s=60)
+    cache.record_failure("hash")
+
+    assert cache.failed_recently("hash")
+    assert not cache.failed_recently("other-hash")
+    assert cache.stats["negative_hits"] == 1
+
+
+def test_failed_summary_expires():
+    cache = SummaryCache(max_size=4, failure_ttl_s=0)
+    cache.record_failure("hash")
+
+    assert not cache.failed_recently("hash")
+    assert "hash" not in cache.failures
+    assert cache.stats["negative_hits"] == 0
+
+
+def test_summary_clears_a_failure():
+    cache = SummaryCache(max_size=4, failure_ttl_s=60)
+    cache.record_failure("hash")
+    cache.put("hash", {"summary": "text"})
+
+    assert not cache.failed_recently("hash")
+    assert cache.get("hash") == {"summary": "text"}
+
+
+def test_failures_past_max_size_drop_expired_ones():
+    cache = SummaryCache(max_size=2, failure_ttl_s=0)
+    cache.record_failure("first")
+    cache.record_failure("second")
+    cache.failure_ttl_s = 60
+    cache.record_failure("third")
+
+    assert list(cache.failures) == ["third"]
+
+
+def test_least_recently_used_summary_is_evicted():
+    cache = SummaryCache(max_size=2, failure_ttl_s=60)
+    cache.put("first", {"summary": "1"})
+    cache.put("second", {"summary": "2"})
+    cache.get("first")
+    cache.put("third", {"summary": "3"})
+
+    assert cache.get("second") is None
+    assert cache.get("first") == {"summary": "1"}
+    assert cache.stats == {"hits": 2, "misses": 1, "negative_hits": 0}
@@ -19,3 +19,4 @@ export const APPWRITE_CONFIG = {
 };
 
 export const FETCH_INTERVAL = 1000 * 60 * 1; // 1 minute
+export const PREFETCH_ARTICLE_COUNT = 10; // about the first screen of articles
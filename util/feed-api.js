@@ -1,4 +1,4 @@
-import { FETCH_INTERVAL } from './constants';
+import { FETCH_INTERVAL, PREFETCH_ARTICLE_COUNT } from './constants';
 
 export const SUMMARY_FETCH_FAILED_MESSAGE = 'Failed to fetch summary.';
 
@@ -40,6 +40,14 @@ export async function fetchNewsData(state, limit, offset, filter) {
 
     state.setFeedData(feedData);
     state.setLoadedData(feedData);
+
+    // Warm the reader-mode cache so the first articles open without a download
+    state.session.prefetchArticles(
+        feedData
+            .slice(0, PREFETCH_ARTICLE_COUNT)
+            .map((article) => article.article_url)
+            .filter(Boolean)
+    );
 }
 
 export async function loadMoreNewsData(state, feedData, limit, offset, filter) {
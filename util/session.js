@@ -397,6 +397,26 @@ export class UserSession {
         }
     }
 
+    /**
+     * Asks get_article to cache reader-mode content for a batch of articles.
+     * The execution runs asynchronously, so this doesn't wait for the fetches.
+     * @param {Array<string>} urls - The URLs of the articles to prefetch.
+     */
+    async prefetchArticles(urls) {
+        if (urls.length === 0) return;
+        try {
+            await this.functions.createExecution(
+                APPWRITE_CONFIG.GET_ARTICLE_FN,
+                JSON.stringify({ urls: urls }),
+                true,
+                '/',
+                'POST'
+            );
+        } catch (err) {
+            console.error(err);
+        }
+    }
+
     /**
      * Retrieves an article from a given URL and generates HTML content for display.
      * @param {string} url - The URL of the article.